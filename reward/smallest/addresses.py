@@ -0,0 +1,51 @@
+import logging
+
+from django.core.cache import cache
+
+from smallest.bech32 import stake_address
+from smallest.models import StakeAddress
+from smallest.utils import split_array_index
+
+log = logging.getLogger('main')
+redis = cache.client.get_client(True)
+
+"""
+Persistent stake_address id -> bech32 view cache, shared by every campaign.
+dbsync never changes the address of an id, so the hash has no TTL. Ids not cached yet are read
+from dbsync as raw bytes (hash_raw, 29 bytes instead of the 59 chars view) and encoded locally.
+Drop the key after resyncing dbsync from scratch, ids may be assigned differently.
+"""
+CACHE_KEY = 'iso:stake_address'
+
+
+def cached(addr_ids, batch_size=20000):
+    """({addr_id: view} of the cached ids, [addr_id] of the others)."""
+    addr_ids = sorted({*addr_ids})
+    views = {}
+    missing = []
+    for start, end in split_array_index(len(addr_ids), batch_size):
+        batch = addr_ids[start:end]
+        for addr_id, view in zip(batch, redis.hmget(CACHE_KEY, batch)):
+            if view is None:
+                missing.append(addr_id)
+            else:
+                views[addr_id] = view.decode()
+    return views, missing
+
+
+def store(rows):
+    """Encode (addr_id, hash_raw) rows, cache and return them as {addr_id: view}."""
+    views = {addr_id: stake_address(bytes(hash_raw)) for addr_id, hash_raw in rows}
+    if views:
+        redis.hset(CACHE_KEY, mapping=views)
+    return views
+
+
+def resolve(addr_ids, batch_size=20000):
+    """{addr_id: view}, only ids never seen before are read from dbsync."""
+    views, missing = cached(addr_ids, batch_size)
+    log.info('stake_address|cached=%s|missing=%s', len(views), len(missing))
+    for start, end in split_array_index(len(missing), batch_size):
+        rows = StakeAddress.objects.filter(id__in=missing[start:end]).values_list('id', 'hash_raw')
+        views.update(store(rows))
+    return views
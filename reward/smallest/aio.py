@@ -0,0 +1,199 @@
+import asyncio
+import logging
+import re
+import time
+
+import asyncpg
+from django.conf import settings
+
+from smallest import addresses
+from smallest.db import AdaptiveBatch, next_read_alias, notify_query, pin_read_alias
+from smallest.lib import POOL_STAKE_QUERY, STAKE_QUERY, TOTAL_STAKE_QUERY, pools_checkpoint
+from smallest.records import epoch_stake_array
+from smallest.utils import split_array_index
+
+log = logging.getLogger('main')
+
+"""
+Asyncio extraction engine (EXTRACTION_ENGINE=async): fetch_pools, the epoch_stake loads and
+get_map_address of a whole campaign run at once on asyncpg, every query of every pool and epoch
+in flight together up to DB_ASYNC_CONCURRENCY. The first failing query cancels the others and
+is raised to the caller. Django ORM calls are not allowed in here, IsoManager loads pool ids and
+delegations before entering the event loop.
+"""
+
+FIRST_BLOCK_QUERY = 'SELECT id, time FROM block WHERE epoch_no = $1 ORDER BY id LIMIT 1'
+LAST_TX_QUERY = 'SELECT id FROM tx WHERE block_id = $1 ORDER BY id DESC LIMIT 1'
+LEDGER_STAKE_QUERY = """
+SELECT pool_id, sum(amount)
+FROM epoch_stake
+WHERE epoch_no = $1 AND pool_id = ANY($2)
+GROUP BY pool_id
+"""
+EPOCH_STAKE_QUERY = """
+SELECT epoch_no, addr_id, amount, pool_id
+FROM epoch_stake
+WHERE addr_id = ANY($1) AND epoch_no = ANY($2)
+"""
+STAKE_ADDRESS_QUERY = 'SELECT id, hash_raw FROM stake_address WHERE id = ANY($1)'
+
+
+def positional(sql, names):
+    """%(name)s placeholders of a psycopg2 query to asyncpg's $n, numbered in the order of names."""
+    for i, name in enumerate(names, 1):
+        sql = sql.replace('%%(%s)s' % name, '$%s' % i)
+    if re.search(r'%\(\w+\)s', sql):
+        raise ValueError('unmapped placeholder in %s' % sql[:200])
+    return sql
+
+
+async def gather(*aws):
+    """asyncio.gather that cancels the remaining awaitables on the first error."""
+    tasks = [asyncio.ensure_future(a) for a in aws]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+class Reader:
+    """One asyncpg pool per read database, queries go round robin like smallest.db.read_cursor."""
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency or settings.DB_ASYNC_CONCURRENCY
+        self.semaphore = asyncio.BoundedSemaphore(self.concurrency)
+        self.lock = asyncio.Lock()
+        self.pools = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await gather(*[pool.close() for pool in self.pools.values()])
+        self.pools.clear()
+
+    async def get_pool(self, alias):
+        # the first queries all arrive together, only one of them opens the pool
+        async with self.lock:
+            if alias not in self.pools:
+                db = settings.DATABASES[alias]
+                log.info('aio|open_pool|alias=%s|size=%s', alias, self.concurrency)
+                self.pools[alias] = await asyncpg.create_pool(
+                    database=db['NAME'],
+                    user=db['USER'],
+                    password=db['PASSWORD'],
+                    host=db['HOST'],
+                    port=db['PORT'],
+                    min_size=0,
+                    max_size=self.concurrency,
+                    server_settings={'timezone': 'UTC'},
+                )
+            return self.pools[alias]
+
+    async def fetch(self, sql, *args):
+        async with self.semaphore:
+            pool = await self.get_pool(next_read_alias())
+            start = time.perf_counter()
+            # asyncpg prepares and caches every statement per connection
+            rows = await pool.fetch(sql, *args)
+            notify_query(sql, time.perf_counter() - start, len(rows))
+            return rows
+
+
+async def pool_stakes(reader, pool_ids, epoch, engine):
+    """{pool_id: stake} at the start of epoch, same stake sources as IsoManager.pool_stakes."""
+    if engine == 'epoch_stake':
+        rows = await reader.fetch(LEDGER_STAKE_QUERY, epoch + 1, pool_ids)
+        return {pool_id: int(total) for pool_id, total in rows}
+
+    first_block = (await reader.fetch(FIRST_BLOCK_QUERY, epoch))[0]
+    last_tx_id = (await reader.fetch(LAST_TX_QUERY, first_block['id']))[0]['id']
+    if engine == 'set':
+        sql = positional(POOL_STAKE_QUERY, ['pool_ids', 'max_tx', 'effective_time', 'epoch'])
+        rows = await reader.fetch(sql, pool_ids, last_tx_id, first_block['time'], epoch)
+        return {pool_id: int(total) for pool_id, total in rows}
+    if engine != 'batch':
+        raise ValueError('pool_stakes|engine=%s|not supported by the async engine' % engine)
+
+    batches = AdaptiveBatch(20)
+    checkpoint = pools_checkpoint(pool_ids, epoch)
+    # Redis calls are blocking, they run in a thread so the other epochs keep going
+    progress = await asyncio.to_thread(checkpoint.load)
+
+    async def _pool(pool_id):
+        state = progress.get(str(pool_id), {'offset': 0, 'total': 0, 'done': False})
+        if state['done']:
+            return pool_id, state['total']
+        rows = await reader.fetch(STAKE_QUERY.sql, pool_id, last_tx_id)
+        stake_address_ids = sorted(r[0] for r in rows)
+        offset = state['offset']
+        total_stake = state['total']
+        for batch in batches.split(stake_address_ids[offset:]):
+            start = time.perf_counter()
+            rows = await reader.fetch(TOTAL_STAKE_QUERY.sql, first_block['time'], batch, epoch, last_tx_id)
+            batches.observe(len(batch), time.perf_counter() - start)
+            offset += len(batch)
+            if rows[0][0] is None:
+                log.error('get_pools|pool_not_exists|pool_id=%s|addr_ids=%s', pool_id, batch)
+            else:
+                total_stake += int(rows[0][0])
+            state = {'offset': offset, 'total': total_stake, 'done': False}
+            await asyncio.to_thread(checkpoint.commit, pool_id, state)
+        state = {'offset': offset, 'total': total_stake, 'done': True}
+        await asyncio.to_thread(checkpoint.commit, pool_id, state)
+        return pool_id, total_stake
+
+    # cleared by IsoManager.save_pools once the result is stored
+    return dict(await gather(*[_pool(p) for p in pool_ids]))
+
+
+async def epoch_stakes(reader, addr_ids, epoch_nos, batch_size=2000):
+    """Same result as smallest.stakes.load_epoch_stakes, every batch in flight at once."""
+    addr_ids = sorted({*addr_ids})
+    epoch_nos = sorted({*epoch_nos})
+    chunks = {epoch_no: [] for epoch_no in epoch_nos}
+    if not addr_ids or not epoch_nos:
+        return {epoch_no: epoch_stake_array([]) for epoch_no in epoch_nos}
+
+    batches = await gather(*[reader.fetch(EPOCH_STAKE_QUERY, addr_ids[s:e], epoch_nos)
+                             for s, e in split_array_index(len(addr_ids), batch_size)])
+    for rows in batches:
+        for epoch_no, addr_id, amount, pool_id in rows:
+            chunks[epoch_no].append((addr_id, int(amount), pool_id))
+    return {epoch_no: epoch_stake_array([c]) for epoch_no, c in chunks.items()}
+
+
+async def stake_addresses(reader, addr_ids, batch_size=20000):
+    """Same as smallest.addresses.resolve, ids missing from the cache are read in concurrent batches."""
+    views, missing = await asyncio.to_thread(addresses.cached, addr_ids, batch_size)
+    batches = await gather(*[reader.fetch(STAKE_ADDRESS_QUERY, missing[s:e])
+                             for s, e in split_array_index(len(missing), batch_size)])
+    for rows in batches:
+        views.update(await asyncio.to_thread(addresses.store, rows))
+    return views
+
+
+async def extract(pool_ids, pool_epochs, stake_epoch_nos, addr_ids, engine, with_addresses=True):
+    """
+    Pool stakes of every epoch in pool_epochs, epoch_stake rows of stake_epoch_nos and,
+    with_addresses, the stake address views, all overlapped on one reader.
+    Returns ({epoch: {pool_id: stake}}, {epoch_no: EPOCH_STAKE_DTYPE array}, {addr_id: view} or None).
+    """
+    async with Reader() as reader:
+        async def _pools(epoch):
+            # each epoch runs in its own task, the pin stays in its context
+            with pin_read_alias():
+                return epoch, await pool_stakes(reader, pool_ids, epoch, engine)
+
+        async def _addresses():
+            return await stake_addresses(reader, addr_ids) if with_addresses else None
+
+        pools, stakes, map_address = await gather(
+            gather(*[_pools(e) for e in pool_epochs]),
+            epoch_stakes(reader, addr_ids, stake_epoch_nos),
+            _addresses(),
+        )
+    return dict(pools), stakes, map_address
@@ -0,0 +1,294 @@
+import logging
+import struct
+import time
+import zlib
+from datetime import datetime, timezone
+
+import numpy as np
+
+from smallest.db import read_cursor, stream
+from smallest.metrics import label_query
+
+log = logging.getLogger('main')
+
+"""
+Incremental balance ledger of FETCH_POOLS_ENGINE=incremental: the balance of every live delegator of
+the campaign pools at an epoch boundary (first block of the epoch), kept in the result cache.
+The next boundary starts from the previous epoch's ledger and only reads the activity between the two:
+outputs created in between and still unspent, outputs spent in between, rewards that became spendable,
+reserve and treasury payouts and withdrawals. Balances are the same as POOL_STAKE_QUERY's.
+Full histories are only read for delegators missing from the previous ledger, for the first epoch sized,
+and across the Allegra boundary, which drops the genesis outputs.
+"""
+# boundary (epoch, first_tx, max_tx, effective_time, rows), then the zlib compressed addr_ids and balances
+HEADER = struct.Struct('<qqqqI')
+ALLEGRA_TIME = datetime(2020, 12, 16, 21, 44, tzinfo=timezone.utc)
+
+"""
+live_delegation: the addresses delegated to one of %(pool_ids)s at %(max_tx)s, see POOL_STAKE_QUERY.
+"""
+LIVE_DELEGATION_CTE = """
+WITH candidate AS (
+    SELECT DISTINCT addr_id
+    FROM delegation
+    WHERE pool_hash_id = ANY(%(pool_ids)s)
+      AND tx_id <= %(max_tx)s
+),
+last_delegation AS (
+    SELECT addr_id, pool_hash_id, tx_id
+    FROM (SELECT d.addr_id, d.pool_hash_id, d.tx_id,
+                 row_number() OVER (PARTITION BY d.addr_id ORDER BY d.tx_id DESC) AS rn
+          FROM delegation d
+                   INNER JOIN candidate c ON c.addr_id = d.addr_id
+          WHERE d.tx_id <= %(max_tx)s) AS ranked
+    WHERE rn = 1
+),
+live_delegation AS (
+    SELECT ld.addr_id, ld.pool_hash_id
+    FROM last_delegation ld
+    WHERE ld.pool_hash_id = ANY(%(pool_ids)s)
+      AND NOT EXISTS
+        (SELECT TRUE
+         FROM stake_deregistration sd
+         WHERE sd.addr_id = ld.addr_id
+           AND sd.tx_id > ld.tx_id
+           AND sd.tx_id <= %(max_tx)s)
+)"""
+
+"""
+BOUNDARY_QUERY: time, first and last tx of the first block of %(epoch)s, as IsoManager.pool_stakes reads them.
+"""
+BOUNDARY_QUERY = """
+-- BOUNDARY_QUERY
+SELECT b.time, min(t.id), max(t.id)
+FROM block b
+         INNER JOIN tx t ON t.block_id = b.id
+WHERE b.id = (SELECT min(id) FROM block WHERE epoch_no = %(epoch)s)
+GROUP BY b.time
+"""
+
+LIVE_DELEGATION_QUERY = """
+-- LIVE_DELEGATION_QUERY""" + LIVE_DELEGATION_CTE + """
+SELECT addr_id, pool_hash_id FROM live_delegation
+"""
+
+"""
+BALANCE_QUERY: full balance of %(addr_ids)s at a boundary, the balance sources of POOL_STAKE_QUERY per address.
+"""
+BALANCE_QUERY = """
+-- BALANCE_QUERY
+WITH address AS (SELECT unnest(%(addr_ids)s::bigint[]) AS addr_id),
+balance AS (
+    SELECT t.stake_address_id AS addr_id, t.value AS amount
+    FROM tx_out AS t
+             INNER JOIN address a ON a.addr_id = t.stake_address_id
+             INNER JOIN tx AS generating_tx ON generating_tx.id = t.tx_id
+             INNER JOIN block AS generating_block ON generating_block.id = generating_tx.block_id
+             LEFT JOIN tx_in AS consuming_input ON consuming_input.tx_out_id = generating_tx.id
+        AND consuming_input.tx_out_index = t.index
+             LEFT JOIN tx AS consuming_tx ON consuming_tx.id = consuming_input.tx_in_id
+             LEFT JOIN block AS consuming_block ON consuming_block.id = consuming_tx.block_id
+    WHERE (%(effective_time)s < '2020-12-16 21:44:00'::timestamp OR generating_block.epoch_no IS NOT NULL)
+      AND %(effective_time)s >= generating_block.time
+      AND (%(effective_time)s <= consuming_block.time OR consuming_input.id IS NULL)
+    UNION ALL
+    SELECT r.addr_id, r.amount
+    FROM reward r
+             INNER JOIN address a ON a.addr_id = r.addr_id
+    WHERE r.spendable_epoch <= %(epoch)s
+    UNION ALL
+    SELECT r.addr_id, r.amount
+    FROM reserve r
+             INNER JOIN address a ON a.addr_id = r.addr_id
+    WHERE r.tx_id <= %(max_tx)s
+    UNION ALL
+    SELECT t.addr_id, t.amount
+    FROM treasury t
+             INNER JOIN address a ON a.addr_id = t.addr_id
+    WHERE t.tx_id <= %(max_tx)s
+    UNION ALL
+    SELECT w.addr_id, -w.amount
+    FROM withdrawal w
+             INNER JOIN address a ON a.addr_id = w.addr_id
+    WHERE w.tx_id <= %(max_tx)s
+)
+SELECT addr_id, SUM(amount)
+FROM balance
+GROUP BY addr_id
+"""
+
+"""
+BALANCE_DELTA_QUERY: balance change of %(addr_ids)s from the boundary (%(prev_epoch)s, %(prev_first_tx)s,
+%(prev_max_tx)s, %(prev_effective_time)s) to (%(epoch)s, %(max_tx)s, %(effective_time)s).
+Blocks are in time order, so the tx id ranges only bound the scans, the time conditions are the ones of BALANCE_QUERY:
+- created after the previous boundary: tx_id > prev_max_tx, and up to this one: tx_id <= max_tx.
+- spent from the previous boundary (its first block included): tx_in_id >= prev_first_tx, before this one: <= max_tx.
+Both boundaries must be on the same side of the Allegra hard fork.
+"""
+BALANCE_DELTA_QUERY = """
+-- BALANCE_DELTA_QUERY
+WITH address AS (SELECT unnest(%(addr_ids)s::bigint[]) AS addr_id),
+delta AS (
+    -- created since the previous boundary, unspent at this one
+    SELECT t.stake_address_id AS addr_id, t.value AS amount
+    FROM tx_out AS t
+             INNER JOIN address a ON a.addr_id = t.stake_address_id
+             INNER JOIN tx AS generating_tx ON generating_tx.id = t.tx_id
+             INNER JOIN block AS generating_block ON generating_block.id = generating_tx.block_id
+             LEFT JOIN tx_in AS consuming_input ON consuming_input.tx_out_id = generating_tx.id
+        AND consuming_input.tx_out_index = t.index
+             LEFT JOIN tx AS consuming_tx ON consuming_tx.id = consuming_input.tx_in_id
+             LEFT JOIN block AS consuming_block ON consuming_block.id = consuming_tx.block_id
+    WHERE t.tx_id > %(prev_max_tx)s AND t.tx_id <= %(max_tx)s
+      AND (%(effective_time)s < '2020-12-16 21:44:00'::timestamp OR generating_block.epoch_no IS NOT NULL)
+      AND %(prev_effective_time)s < generating_block.time
+      AND %(effective_time)s >= generating_block.time
+      AND (%(effective_time)s <= consuming_block.time OR consuming_input.id IS NULL)
+    UNION ALL
+    -- unspent at the previous boundary, spent before this one
+    SELECT t.stake_address_id, -t.value
+    FROM tx_in AS consuming_input
+             INNER JOIN tx AS consuming_tx ON consuming_tx.id = consuming_input.tx_in_id
+             INNER JOIN block AS consuming_block ON consuming_block.id = consuming_tx.block_id
+             INNER JOIN tx_out AS t ON t.tx_id = consuming_input.tx_out_id
+        AND t.index = consuming_input.tx_out_index
+             INNER JOIN address a ON a.addr_id = t.stake_address_id
+             INNER JOIN tx AS generating_tx ON generating_tx.id = t.tx_id
+             INNER JOIN block AS generating_block ON generating_block.id = generating_tx.block_id
+    WHERE consuming_input.tx_in_id >= %(prev_first_tx)s AND consuming_input.tx_in_id <= %(max_tx)s
+      AND (%(effective_time)s < '2020-12-16 21:44:00'::timestamp OR generating_block.epoch_no IS NOT NULL)
+      AND %(prev_effective_time)s >= generating_block.time
+      AND %(prev_effective_time)s <= consuming_block.time
+      AND %(effective_time)s > consuming_block.time
+    UNION ALL
+    SELECT r.addr_id, r.amount
+    FROM reward r
+             INNER JOIN address a ON a.addr_id = r.addr_id
+    WHERE r.spendable_epoch > %(prev_epoch)s AND r.spendable_epoch <= %(epoch)s
+    UNION ALL
+    SELECT r.addr_id, r.amount
+    FROM reserve r
+             INNER JOIN address a ON a.addr_id = r.addr_id
+    WHERE r.tx_id > %(prev_max_tx)s AND r.tx_id <= %(max_tx)s
+    UNION ALL
+    SELECT t.addr_id, t.amount
+    FROM treasury t
+             INNER JOIN address a ON a.addr_id = t.addr_id
+    WHERE t.tx_id > %(prev_max_tx)s AND t.tx_id <= %(max_tx)s
+    UNION ALL
+    SELECT w.addr_id, -w.amount
+    FROM withdrawal w
+             INNER JOIN address a ON a.addr_id = w.addr_id
+    WHERE w.tx_id > %(prev_max_tx)s AND w.tx_id <= %(max_tx)s
+)
+SELECT addr_id, SUM(amount)
+FROM delta
+GROUP BY addr_id
+"""
+
+# the queries open with their name, their first lines are alike (see smallest.metrics.query_label)
+label_query('BOUNDARY_QUERY', BOUNDARY_QUERY)
+label_query('LIVE_DELEGATION_QUERY', LIVE_DELEGATION_QUERY)
+label_query('BALANCE_QUERY', BALANCE_QUERY)
+label_query('BALANCE_DELTA_QUERY', BALANCE_DELTA_QUERY)
+
+
+class Boundary:
+    """Balances of sorted addr_ids at the first block of epoch."""
+
+    def __init__(self, epoch, first_tx, max_tx, effective_time, addr_ids, balances):
+        self.epoch = epoch
+        self.first_tx = first_tx
+        self.max_tx = max_tx
+        self.effective_time = effective_time
+        self.addr_ids = addr_ids
+        self.balances = balances
+
+    def encode(self):
+        header = HEADER.pack(self.epoch, self.first_tx, self.max_tx, int(self.effective_time.timestamp()),
+                             len(self.addr_ids))
+        return header + zlib.compress(self.addr_ids.tobytes() + self.balances.tobytes(), 1)
+
+    @classmethod
+    def decode(cls, data):
+        epoch, first_tx, max_tx, effective_time, rows = HEADER.unpack_from(data)
+        payload = np.frombuffer(zlib.decompress(data[HEADER.size:]), dtype='<i8')
+        return cls(epoch, first_tx, max_tx, datetime.fromtimestamp(effective_time, timezone.utc),
+                   payload[:rows].copy(), payload[rows:].copy())
+
+
+def _balances(conn, sql, params, addr_ids):
+    """Balances of sorted addr_ids from a (addr_id, sum) query, 0 for the addresses without rows."""
+    balances = np.zeros(len(addr_ids), dtype=np.int64)
+    if not len(addr_ids):
+        return balances
+    rows = [(addr_id, int(total))
+            for addr_id, total in stream(sql, {**params, 'addr_ids': addr_ids.tolist()}, conn=conn)]
+    if rows:
+        ids, totals = np.array(rows, dtype=np.int64).T
+        balances[np.searchsorted(addr_ids, ids)] = totals
+    return balances
+
+
+class BalanceLedger:
+    """Boundaries of one set of pools, each one derived from the previous epoch's when it is cached."""
+
+    def __init__(self, pool_ids, results):
+        self.pool_ids = sorted(pool_ids)
+        self.results = results
+
+    def key(self, epoch):
+        return self.results.key('balance_ledger', pool_ids=self.pool_ids, epoch=epoch)
+
+    def load(self, epoch):
+        data = self.results.get(self.key(epoch))
+        return Boundary.decode(data) if data else None
+
+    def pool_stakes(self, epoch):
+        """{pool_id: stake} at the boundary, the same as POOL_STAKE_QUERY, and the boundary cached for epoch + 1."""
+        with read_cursor() as cursor:
+            # one transaction snapshot for the boundary and every balance: a replica replaying dbsync meanwhile
+            # must not move the block, the delegators and the balances apart
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            return self._pool_stakes(cursor, epoch)
+
+    def _pool_stakes(self, cursor, epoch):
+        start = time.perf_counter()
+        conn = cursor.connection
+        cursor.execute(BOUNDARY_QUERY, {'epoch': epoch})
+        effective_time, first_tx, max_tx = cursor.fetchone()
+        # block.time is a UTC timestamp without time zone
+        effective_time = effective_time.replace(tzinfo=timezone.utc)
+        live = np.array(list(stream(LIVE_DELEGATION_QUERY, {'pool_ids': self.pool_ids, 'max_tx': max_tx}, conn=conn)),
+                        dtype=np.int64).reshape(-1, 2)
+        live = live[np.argsort(live[:, 0])]
+        addr_ids = live[:, 0].copy()
+        params = {'epoch': epoch, 'max_tx': max_tx, 'effective_time': effective_time}
+
+        prev = self.load(epoch - 1)
+        if prev and (prev.effective_time < ALLEGRA_TIME) != (effective_time < ALLEGRA_TIME):
+            log.info('balance_ledger|allegra|epoch=%s', epoch)
+            prev = None
+        known = np.isin(addr_ids, prev.addr_ids) if prev else np.zeros(len(addr_ids), dtype=bool)
+
+        balances = np.zeros(len(addr_ids), dtype=np.int64)
+        if known.any():
+            delta = _balances(conn, BALANCE_DELTA_QUERY, {
+                **params,
+                'prev_epoch': prev.epoch,
+                'prev_first_tx': prev.first_tx,
+                'prev_max_tx': prev.max_tx,
+                'prev_effective_time': prev.effective_time,
+            }, addr_ids[known])
+            balances[known] = prev.balances[np.searchsorted(prev.addr_ids, addr_ids[known])] + delta
+        balances[~known] = _balances(conn, BALANCE_QUERY, params, addr_ids[~known])
+
+        boundary = Boundary(epoch, first_tx, max_tx, effective_time, addr_ids, balances)
+        self.results.set(self.key(epoch), boundary.encode())
+        log.info('balance_ledger|epoch=%s|delegators=%s|incremental=%s|full=%s|time=%.3f',
+                 epoch, len(addr_ids), int(known.sum()), int((~known).sum()), time.perf_counter() - start)
+
+        pool_ids, index = np.unique(live[:, 1], return_inverse=True)
+        totals = np.zeros(len(pool_ids), dtype=np.int64)
+        np.add.at(totals, index, balances)
+        return dict(zip(pool_ids.tolist(), totals.tolist()))
@@ -0,0 +1,63 @@
+"""
+Bech32 (BIP-173) encoding of Cardano stake addresses, so the views of stake_address can be built
+from the raw 29 bytes (header + stake credential hash) instead of being read from dbsync.
+"""
+
+CHARSET = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+GENERATOR = [0x3b6a57b2, 0x26508e6d, 0x1ea119fa, 0x3d4233dd, 0x2a1462b3]
+
+
+def _table_entry(top):
+    value = 0
+    for i, g in enumerate(GENERATOR):
+        if (top >> i) & 1:
+            value ^= g
+    return value
+
+
+# xor applied to the checksum state for each value of its top 5 bits
+POLYMOD_TABLE = [_table_entry(top) for top in range(32)]
+
+
+def _polymod(values, chk=1):
+    for v in values:
+        chk = ((chk & 0x1ffffff) << 5) ^ v ^ POLYMOD_TABLE[chk >> 25]
+    return chk
+
+
+def _hrp_state(hrp):
+    return _polymod([ord(x) >> 5 for x in hrp] + [0] + [ord(x) & 31 for x in hrp])
+
+
+def _to_5bit(data):
+    acc = 0
+    bits = 0
+    out = []
+    for byte in data:
+        acc = ((acc << 8) | byte) & 0xfff
+        bits += 8
+        while bits >= 5:
+            bits -= 5
+            out.append((acc >> bits) & 31)
+    if bits:
+        out.append((acc << (5 - bits)) & 31)
+    return out
+
+
+# checksum state after the human readable part, computed once per prefix
+_HRP_STATES = {}
+
+
+def encode(hrp, data):
+    if hrp not in _HRP_STATES:
+        _HRP_STATES[hrp] = _hrp_state(hrp)
+    five = _to_5bit(data)
+    polymod = _polymod(five + [0] * 6, _HRP_STATES[hrp]) ^ 1
+    checksum = [(polymod >> 5 * (5 - i)) & 31 for i in range(6)]
+    return hrp + '1' + ''.join([CHARSET[d] for d in five + checksum])
+
+
+def stake_address(hash_raw):
+    # low nibble of the header is the network id: 1 for mainnet, 0 for the testnets
+    hrp = 'stake' if hash_raw[0] & 0x0f == 1 else 'stake_test'
+    return encode(hrp, hash_raw)
@@ -0,0 +1,288 @@
+import contextvars
+import functools
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, ExitStack
+
+from django.conf import settings
+from django.db import connections
+from psycopg2.extensions import connection as pg_connection, cursor as pg_cursor
+from psycopg2.pool import ThreadedConnectionPool
+
+log = logging.getLogger('main')
+
+_lock = threading.Lock()
+_pools = {}
+_pid = None
+_read_aliases = None
+# callbacks(sql, duration, rowcount) run after every reward query, see observe_queries
+_query_observers = []
+# names of the server-side cursors of stream()
+_stream_ids = itertools.count()
+# read database of the current run or stage, see pin_read_alias
+_pinned_alias = contextvars.ContextVar('pinned_read_alias', default=None)
+
+
+def read_aliases():
+    """Aliases serving the read-only reward queries: every replica_* database, or default when none is configured."""
+    global _read_aliases
+    if _read_aliases is None:
+        replicas = sorted(a for a in settings.DATABASES if a.startswith('replica'))
+        _read_aliases = itertools.cycle(replicas or ['default'])
+    return _read_aliases
+
+
+def next_read_alias():
+    pinned = _pinned_alias.get()
+    if pinned:
+        return pinned
+    with _lock:
+        return next(read_aliases())
+
+
+@contextmanager
+def pin_read_alias():
+    """
+    Send every read inside, ORM, read_cursor, stream and smallest.aio alike, to the same read database,
+    so one epoch task never mixes replicas lagging by different amounts. Nested pins keep the outer one,
+    pin the smallest unit of work so the tasks of a campaign still spread over the replicas.
+    Threads start with an empty context, run their work through contextvars.copy_context() to keep the pin.
+    """
+    token = _pinned_alias.set(next_read_alias())
+    try:
+        yield _pinned_alias.get()
+    finally:
+        _pinned_alias.reset(token)
+
+
+def pinned_reads(func):
+    """Decorator running func inside pin_read_alias."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with pin_read_alias():
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+# tables of ours in the smallest app, written on default and not replicated with dbsync:
+# the router reads them on default, raw SQL over them must stream with alias='default'
+LOCAL_TABLES = {'min_delegation', 'min_delegation_pool'}
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        # only dbsync tables are on the replicas
+        if model._meta.app_label != 'smallest' or model._meta.db_table in LOCAL_TABLES:
+            return 'default'
+        return next_read_alias()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+def notify_query(sql, duration, rowcount):
+    """Report a query run outside Django and the pooled cursors (smallest.aio) to observe_queries."""
+    for observer in _query_observers:
+        observer(sql, duration, rowcount)
+
+
+class ObservedCursor(pg_cursor):
+    def execute(self, query, vars=None):
+        if not _query_observers:
+            return super().execute(query, vars)
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            notify_query(query, time.perf_counter() - start, self.rowcount)
+
+
+@contextmanager
+def observe_queries(observer):
+    """Call observer(sql, duration, rowcount) for every query, pooled raw cursors and Django ORM alike."""
+
+    def _wrapper(execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            observer(sql, time.perf_counter() - start, context['cursor'].rowcount)
+
+    _query_observers.append(observer)
+    try:
+        with ExitStack() as stack:
+            for alias in settings.DATABASES:
+                stack.enter_context(connections[alias].execute_wrapper(_wrapper))
+            yield
+    finally:
+        _query_observers.remove(observer)
+
+
+class PreparedConnection(pg_connection):
+    """Connection remembering the statements prepared on its server session."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class PreparedStatement:
+    """
+    Server-side prepared statement, parsed and planned once per pooled connection.
+    Parameters are positional ($1, $2, ...) and lists are sent as arrays, so batches of any size
+    share one statement instead of inlining IN (...) lists.
+    """
+
+    def __init__(self, name, types, sql):
+        self.name = name
+        self.types = types
+        self.sql = sql
+
+    def execute(self, cursor, *params):
+        prepared = cursor.connection.prepared
+        if self.name not in prepared:
+            # PREPARE is not transactional, the statement survives the rollback of BoundedPool.connection
+            cursor.execute('PREPARE %s (%s) AS %s' % (self.name, ', '.join(self.types), self.sql))
+            prepared.add(self.name)
+        cursor.execute('EXECUTE %s (%s)' % (self.name, ', '.join(['%s'] * len(params))), params)
+
+
+class AdaptiveBatch:
+    """
+    Batch size tuned from observed queries: it grows while batches finish under DB_BATCH_TARGET_TIME
+    and shrinks when they take longer.
+    Thread-safe, worker threads share one instance so every batch benefits from what the others measured.
+    """
+
+    def __init__(self, size, minimum=None, maximum=20000):
+        self.size = size
+        self.minimum = minimum or size
+        self.maximum = maximum
+        self.lock = threading.Lock()
+
+    def split(self, items):
+        start = 0
+        while start < len(items):
+            end = min(start + self.size, len(items))
+            yield items[start:end]
+            start = end
+
+    def observe(self, items, duration):
+        with self.lock:
+            # at most double or halve at once, a single slow batch must not collapse the size
+            factor = min(max(settings.DB_BATCH_TARGET_TIME / max(duration, 0.001), 0.5), 2.0)
+            self.size = int(min(max(items * factor, self.minimum), self.maximum))
+
+
+class BoundedPool:
+    """
+    ThreadedConnectionPool that blocks callers once `size` connections are checked out,
+    instead of raising PoolError.
+    """
+
+    def __init__(self, alias, size):
+        db = settings.DATABASES[alias]
+        self.alias = alias
+        self.semaphore = threading.BoundedSemaphore(size)
+        self.pool = ThreadedConnectionPool(
+            0, size,
+            dbname=db['NAME'],
+            user=db['USER'],
+            password=db['PASSWORD'],
+            host=db['HOST'],
+            port=db['PORT'],
+            options='-c timezone=UTC',
+            connection_factory=PreparedConnection,
+            cursor_factory=ObservedCursor,
+        )
+
+    @contextmanager
+    def connection(self):
+        with self.semaphore:
+            conn = self.pool.getconn()
+            try:
+                yield conn
+            finally:
+                # reward queries are read-only, end the transaction before handing the connection back
+                conn.rollback()
+                self.pool.putconn(conn)
+
+    def close(self):
+        self.pool.closeall()
+
+
+def get_pool(alias):
+    global _pid
+    with _lock:
+        if _pid != os.getpid():
+            # forked worker, never touch the parent's sockets
+            _pools.clear()
+            _pid = os.getpid()
+        if alias not in _pools:
+            log.info('db|open_pool|alias=%s|size=%s', alias, settings.DB_POOL_SIZE)
+            _pools[alias] = BoundedPool(alias, settings.DB_POOL_SIZE)
+        return _pools[alias]
+
+
+@contextmanager
+def read_cursor():
+    """Cursor on the next read database, taken from its bounded pool."""
+    with get_pool(next_read_alias()).connection() as conn:
+        with conn.cursor() as cursor:
+            yield cursor
+
+
+def _iter_named(conn, sql, params, fetch_size):
+    start = time.perf_counter()
+    rows = 0
+    # a plain cursor class, the whole stream is reported once to observe_queries below
+    with conn.cursor(name='iso_stream_%s' % next(_stream_ids), cursor_factory=pg_cursor) as cursor:
+        cursor.itersize = fetch_size or settings.DB_STREAM_FETCH_SIZE
+        cursor.execute(sql.strip().rstrip(';'), params)
+        for row in cursor:
+            rows += 1
+            yield row
+    notify_query(sql, time.perf_counter() - start, rows)
+
+
+def stream(sql, params=None, fetch_size=None, conn=None, alias=None):
+    """
+    Rows of a read query through a named server-side cursor, fetch_size (DB_STREAM_FETCH_SIZE) rows per
+    round trip, so neither side holds the whole result. Runs on conn, or on a pooled connection of alias
+    (default: the next read database) held until the generator is exhausted or closed.
+    """
+    if conn is not None:
+        yield from _iter_named(conn, sql, params, fetch_size)
+        return
+    with get_pool(alias or next_read_alias()).connection() as conn:
+        yield from _iter_named(conn, sql, params, fetch_size)
+
+
+def stream_queryset(queryset, fetch_size=None):
+    """
+    Rows of a values_list queryset through stream(), on the pooled connections of the database the queryset
+    reads (router or .using()) instead of Django's.
+    """
+    alias = queryset.db
+    sql, params = queryset.query.get_compiler(using=alias).as_sql()
+    return stream(sql, params, fetch_size, alias=alias)
+
+
+def close_pools():
+    with _lock:
+        if _pid == os.getpid():
+            for alias, pool in _pools.items():
+                log.info('db|close_pool|alias=%s', alias)
+                pool.close()
+        _pools.clear()
@@ -0,0 +1,177 @@
+import logging
+import struct
+import zlib
+
+import numpy as np
+from django.conf import settings
+from django.db import connections
+
+from smallest.db import pinned_reads, read_cursor, stream, stream_queryset
+from smallest.metrics import label_query
+from smallest.models import Delegation, Tx, Block
+from smallest.records import DELEGATION_DTYPE
+from smallest.utils import split_array_index
+
+log = logging.getLogger('main')
+
+# persisted index: tx_id high-water mark then the zlib compressed DELEGATION_DTYPE rows
+HEADER = struct.Struct('<q')
+
+MIN_DELEGATION_QUERY = """
+SELECT addr_id, active_epoch_no, tx_id, pool_hash_id, epoch_no, extract(epoch FROM time)::bigint
+FROM min_delegation
+WHERE pool_hash_id = ANY(%(pool_ids)s::bigint[]) AND tx_id > %(tx_id)s AND tx_id <= %(max_tx)s
+"""
+label_query('MIN_DELEGATION_QUERY', MIN_DELEGATION_QUERY)
+
+# last tx of the block FOLLOW_CONFIRMATIONS below the tip: rows up to it are not rolled back anymore
+CONFIRMED_TX_QUERY = """
+SELECT id
+FROM tx
+WHERE block_id <= (SELECT id
+                   FROM block
+                   WHERE block_no <= (SELECT max(block_no) FROM block) - %(confirmations)s
+                   ORDER BY block_no DESC
+                   LIMIT 1)
+ORDER BY id DESC
+LIMIT 1
+"""
+label_query('CONFIRMED_TX_QUERY', CONFIRMED_TX_QUERY)
+
+# tx of the delegation id the pools are indexed up to in min_delegation, see min_delegation.refresh
+MIN_DELEGATION_TX_QUERY = """
+SELECT d.tx_id
+FROM delegation d
+WHERE d.id = (SELECT min(delegation_id) FROM min_delegation_pool WHERE pool_hash_id = ANY(%(pool_ids)s::bigint[]))
+"""
+
+
+def confirmed_tx_id(cursor):
+    """Last tx id deep enough below the tip to be final, 0 on a chain shorter than FOLLOW_CONFIRMATIONS."""
+    cursor.execute(CONFIRMED_TX_QUERY, {'confirmations': settings.FOLLOW_CONFIRMATIONS})
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def latest_per_key(rows):
+    """Rows sorted by (addr_id, active_epoch_no), keeping the highest tx_id of each pair."""
+    rows = rows[np.lexsort((rows['tx_id'], rows['active_epoch_no'], rows['addr_id']))]
+    if not len(rows):
+        return rows
+    last = np.ones(len(rows), dtype=bool)
+    last[:-1] = (rows['addr_id'][1:] != rows['addr_id'][:-1]) \
+        | (rows['active_epoch_no'][1:] != rows['active_epoch_no'][:-1])
+    return rows[last]
+
+
+class DelegationIndex:
+    """
+    Latest delegation per (addr_id, active_epoch_no) for a set of pools, persisted in the result cache
+    as a DELEGATION_DTYPE array. `tx_id` is the high-water mark: refresh() only reads delegation rows above it,
+    up to a confirmed tx (see confirmed_tx_id), so a rolled back delegation never enters the saved index.
+    """
+
+    def __init__(self, pool_ids, results, source='dbsync'):
+        self.pool_ids = sorted(pool_ids)
+        self.results = results
+        # dbsync or min_delegation, both give the same rows
+        self.source = source
+        self.key = results.key('delegation_index', pool_ids=self.pool_ids)
+        self.tx_id = 0
+        self.rows = np.zeros(0, dtype=DELEGATION_DTYPE)
+
+    def load(self):
+        data = self.results.get(self.key)
+        if not data:
+            return self
+        (self.tx_id,) = HEADER.unpack_from(data)
+        self.rows = np.frombuffer(zlib.decompress(data[HEADER.size:]), dtype=DELEGATION_DTYPE).copy()
+        return self
+
+    def save(self):
+        self.results.set(self.key, HEADER.pack(self.tx_id) + zlib.compress(self.rows.tobytes(), 1))
+
+    @pinned_reads
+    def refresh(self):
+        if self.source == 'min_delegation':
+            max_tx = self._min_delegation_tx()
+            rows = self._read_min_delegation(max_tx)
+        else:
+            with read_cursor() as cursor:
+                max_tx = confirmed_tx_id(cursor)
+            rows = self._read_dbsync(max_tx)
+        log.info('delegation_index|refresh|source=%s|tx_id=%s|max_tx=%s|new=%s',
+                 self.source, self.tx_id, max_tx, len(rows))
+        if max_tx <= self.tx_id:
+            return self
+
+        self.tx_id = max_tx
+        if len(rows):
+            self.rows = latest_per_key(np.concatenate([self.rows, rows]))
+        self.save()
+        return self
+
+    def _min_delegation_tx(self):
+        with connections['default'].cursor() as cursor:
+            cursor.execute(MIN_DELEGATION_TX_QUERY, {'pool_ids': self.pool_ids})
+            row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def _read_min_delegation(self, max_tx):
+        rows = stream(MIN_DELEGATION_QUERY, {'pool_ids': self.pool_ids, 'tx_id': self.tx_id, 'max_tx': max_tx},
+                      alias='default')
+        return latest_per_key(np.fromiter(rows, dtype=DELEGATION_DTYPE))
+
+    def _read_dbsync(self, max_tx):
+        query = Delegation.objects.filter(pool_hash_id__in=self.pool_ids, tx_id__gt=self.tx_id, tx_id__lte=max_tx) \
+            .values_list('addr_id', 'active_epoch_no', 'tx_id', 'pool_hash_id')
+
+        # on each epoch, get last delegation of stake address; epoch_no and time are filled below
+        rows = np.fromiter(((*r, 0, 0) for r in stream_queryset(query)), dtype=DELEGATION_DTYPE)
+        rows = latest_per_key(rows)
+        if not len(rows):
+            return rows
+
+        # get transaction info like: epoch, time, tx_id
+        tx_ids = np.unique(rows['tx_id'])
+        tx_blocks = []
+        blocks = []
+        for start, end in split_array_index(len(tx_ids)):
+            d = dict(Tx.objects.filter(id__in=tx_ids[start:end].tolist()).values_list('id', 'block_id'))
+            tx_blocks.extend(d.items())
+            for b in Block.objects.filter(id__in=d.values()):
+                blocks.append((b.id, b.epoch_no, int(b.time.timestamp())))
+        tx_blocks = np.array(sorted(tx_blocks), dtype=np.int64).reshape(-1, 2)
+        if not np.array_equal(tx_blocks[:, 0], tx_ids):
+            raise KeyError('delegation_index|tx_not_found|tx_id=%s' % np.setdiff1d(tx_ids, tx_blocks[:, 0])[:10])
+        blocks = np.array(sorted(set(blocks)), dtype=np.int64).reshape(-1, 3)
+        block_ids = tx_blocks[np.searchsorted(tx_blocks[:, 0], rows['tx_id']), 1]
+        block_index = np.searchsorted(blocks[:, 0], block_ids)
+        rows['epoch_no'] = blocks[block_index, 1]
+        rows['time'] = blocks[block_index, 2]
+        return rows
+
+    def records(self):
+        """DELEGATION_DTYPE array sorted by (active_epoch_no, pool_hash_id)."""
+        return self.rows[np.lexsort((self.rows['pool_hash_id'], self.rows['active_epoch_no']))]
+
+
+def sweep_delegators(delegations, epochs):
+    """
+    Active delegator set of every epoch over a DELEGATION_DTYPE array.
+    Returns {epoch: index array into delegations}, sorted by addr_id, of the last delegation of each address
+    with epoch_no <= epoch. Of several in the same epoch_no, the first one in delegations is kept.
+    """
+    epochs = sorted({*epochs})
+    position = np.arange(len(delegations))
+    # per address by epoch_no, the first of equal epoch_no sorted last so it is the one kept
+    order = np.lexsort((-position, delegations['epoch_no'], delegations['addr_id']))
+    epoch_no = delegations['epoch_no'][order]
+    result = {}
+    for epoch in epochs:
+        index = order[epoch_no <= epoch]
+        addr_ids = delegations['addr_id'][index]
+        last = np.ones(len(index), dtype=bool)
+        last[:-1] = addr_ids[1:] != addr_ids[:-1]
+        result[epoch] = index[last]
+    return result
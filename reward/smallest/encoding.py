@@ -0,0 +1,69 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+from smallest.records import EpochRecord
+
+"""
+Compact epoch_reward encoding, version 1:
+- header: MAGIC, version (uint8), epoch (int64), rows (uint32)
+- zlib payload: int64 columns stake_address_id, pool_hash_id, total_delegate, point,
+    float64 columns percent, reward, uint8 column smallest,
+    then the stake addresses joined by newlines.
+JSON blobs always start with '[' so MAGIC never collides with the legacy format.
+"""
+MAGIC = b'\x00ERC'
+VERSION = 1
+HEADER = struct.Struct('<4sBqI')
+
+INT_COLUMNS = ['stake_address_id', 'pool_hash_id', 'total_delegate', 'point']
+FLOAT_COLUMNS = ['percent', 'reward']
+
+
+def encode_epoch_reward(output, encoding='json'):
+    if encoding == 'json':
+        # default=dict serializes EpochRecord rows as the objects they replace
+        return json.dumps(output, default=dict)
+    if encoding != 'columnar':
+        raise ValueError('unknown epoch_reward encoding: %s' % encoding)
+
+    epoch = output[0]['epoch'] if output else 0
+    parts = []
+    for column in INT_COLUMNS:
+        parts.append(np.array([int(r[column]) for r in output], dtype='<i8').tobytes())
+    for column in FLOAT_COLUMNS:
+        parts.append(np.array([r[column] for r in output], dtype='<f8').tobytes())
+    parts.append(np.array([r['smallest'] for r in output], dtype=np.uint8).tobytes())
+    parts.append('\n'.join(r['stake_address'] for r in output).encode())
+    return HEADER.pack(MAGIC, VERSION, epoch, len(output)) + zlib.compress(b''.join(parts), 1)
+
+
+def decode_epoch_reward(blob):
+    if isinstance(blob, str) or not blob.startswith(MAGIC):
+        return json.loads(blob)
+
+    _, version, epoch, rows = HEADER.unpack_from(blob)
+    if version != VERSION:
+        raise ValueError('unsupported epoch_reward encoding version: %s' % version)
+    payload = zlib.decompress(blob[HEADER.size:])
+
+    columns = {}
+    offset = 0
+    for column in INT_COLUMNS:
+        columns[column] = np.frombuffer(payload, dtype='<i8', count=rows, offset=offset).tolist()
+        offset += rows * 8
+    for column in FLOAT_COLUMNS:
+        columns[column] = np.frombuffer(payload, dtype='<f8', count=rows, offset=offset).tolist()
+        offset += rows * 8
+    columns['smallest'] = np.frombuffer(payload, dtype=np.uint8, count=rows, offset=offset).tolist()
+    offset += rows
+    addresses = payload[offset:].decode().split('\n') if rows else []
+
+    return [
+        EpochRecord(epoch, addresses[i], columns['stake_address_id'][i], str(columns['pool_hash_id'][i]),
+                    columns['total_delegate'][i], columns['point'][i], columns['percent'][i], columns['reward'][i],
+                    columns['smallest'][i])
+        for i in range(rows)
+    ]
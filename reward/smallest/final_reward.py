@@ -0,0 +1,61 @@
+import zlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+redis = cache.client.get_client(True)
+
+"""
+Sharded final_reward output, under a prefix (the campaign's final_reward key):
+- <prefix>.<bucket>: hash stake_address -> reward, bucket = crc32(stake_address) % buckets
+- <prefix>.manifest: hash with count, total and buckets
+Consumers fetch one address with HGET on its bucket, or page through the buckets with HSCAN.
+"""
+
+
+def manifest_key(prefix):
+    return '%s.manifest' % prefix
+
+
+def bucket_key(prefix, stake_address, buckets):
+    return '%s.%s' % (prefix, zlib.crc32(stake_address.encode()) % buckets)
+
+
+def write_sharded(rewards, prefix='final_reward', buckets=None, batch_size=2000):
+    """Write (stake_address, reward) pairs in pipelined batches, then the manifest."""
+    buckets = buckets or settings.FINAL_REWARD_BUCKETS
+    redis.delete(manifest_key(prefix), *['%s.%s' % (prefix, b) for b in range(buckets)])
+
+    count = 0
+    total = 0
+    pipe = redis.pipeline(transaction=False)
+    for stake_address, reward in rewards:
+        pipe.hset(bucket_key(prefix, stake_address, buckets), stake_address, reward)
+        count += 1
+        total += reward
+        if count % batch_size == 0:
+            pipe.execute()
+    pipe.execute()
+
+    redis.hset(manifest_key(prefix), mapping={'count': count, 'total': total, 'buckets': buckets})
+    return count, total
+
+
+def get_manifest(prefix='final_reward'):
+    manifest = redis.hgetall(manifest_key(prefix))
+    return {k.decode(): int(v) for k, v in manifest.items()}
+
+
+def get_reward(stake_address, prefix='final_reward'):
+    manifest = get_manifest(prefix)
+    if not manifest:
+        return None
+    reward = redis.hget(bucket_key(prefix, stake_address, manifest['buckets']), stake_address)
+    return int(reward) if reward is not None else None
+
+
+def iter_rewards(prefix='final_reward', count=2000):
+    manifest = get_manifest(prefix)
+    for bucket in range(manifest.get('buckets', 0)):
+        for stake_address, reward in redis.hscan_iter('%s.%s' % (prefix, bucket), count=count):
+            yield stake_address.decode(), int(reward)
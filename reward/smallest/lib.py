@@ -1,47 +1,69 @@
+import asyncio
+import contextvars
 import csv
 import json
 import logging
-from collections import OrderedDict, namedtuple
+import multiprocessing
+import time
+from collections import namedtuple
+from contextlib import nullcontext
 from decimal import Decimal
 from multiprocessing.pool import ThreadPool
 from collections import defaultdict
 
 from django.conf import settings
 from django.core.cache import cache
-from django.db import connection
-
+from django.db import connections
+from django.db.models import Sum
+import numpy as np
+from redis.exceptions import WatchError
+
+from smallest import addresses, final_reward, min_delegation
+from smallest.balances import LIVE_DELEGATION_CTE, BalanceLedger
+from smallest.db import (AdaptiveBatch, PreparedStatement, close_pools, pin_read_alias, pinned_reads, read_cursor,
+                         stream, stream_queryset)
+from smallest.delegation import DelegationIndex, sweep_delegators
+from smallest.encoding import encode_epoch_reward, decode_epoch_reward
+from smallest.metrics import label_query
 from smallest.models import *
-from smallest.utils import split_array_index, round_down
+from smallest.records import EpochRecord, match_epoch_stakes
+from smallest.results import Checkpoint, ResultCache, content_hash
+from smallest.snapshot import Snapshot
+from smallest.scoring import get_point, get_share, score_points, score_rewards
+from smallest.stakes import load_epoch_stakes
+from smallest.utils import split_array_index
 
 log = logging.getLogger('main')
 redis = cache.client.get_client(True)
 
-STAKE_QUERY = """
+# prepared like TOTAL_STAKE_QUERY: it runs once per pool and epoch on the connection of that pool's batches,
+# and its rows are sorted in memory anyway, so a server-side cursor would not save anything
+STAKE_QUERY = PreparedStatement('STAKE_QUERY', ('bigint', 'bigint'), """
 SELECT d1.addr_id
   FROM delegation d1,
        pool_hash
   WHERE pool_hash.id = d1.pool_hash_id
-    AND pool_hash.id = {pool_id}
-    AND d1.tx_id <= {max_tx}
+    AND pool_hash.id = $1
+    AND d1.tx_id <= $2
     AND NOT EXISTS
       (SELECT TRUE
       FROM delegation d2
       WHERE d2.addr_id = d1.addr_id
     AND d2.tx_id
       > d1.tx_id
-    AND d2.tx_id <= {max_tx})
+    AND d2.tx_id <= $2)
     AND NOT EXISTS
       (SELECT TRUE
       FROM stake_deregistration
       WHERE stake_deregistration.addr_id = d1.addr_id
     AND stake_deregistration.tx_id
       > d1.tx_id
-    AND stake_deregistration.tx_id <= {max_tx})
-"""
+    AND stake_deregistration.tx_id <= $2)
+""")
 
-TOTAL_STAKE_QUERY = """
+TOTAL_STAKE_QUERY = PreparedStatement('TOTAL_STAKE_QUERY', ('timestamp', 'bigint[]', 'integer', 'bigint'), """
 SELECT sum(total)
-FROM (with const as (select to_timestamp('{last_block}', 'YYYY-MM-DD HH24:MI:SS') as effective_time_)
+FROM (with const as (select $1::timestamp as effective_time_)
       select sum(t.value) total
       from const
                cross join tx_out as t
@@ -52,7 +74,7 @@ FROM (with const as (select to_timestamp('{last_block}', 'YYYY-MM-DD HH24:MI:SS'
                left join tx as consuming_tx on consuming_tx.id = consuming_input.tx_in_id
                left join block as consuming_block on consuming_block.id = consuming_tx.block_id
       WHERE
-        t.stake_address_id IN ({stake_addr_ids})
+        t.stake_address_id = ANY($2)
         AND ( -- Ommit outputs from genesis after Allegra hard fork
               const.effective_time_ < '2020-12-16 21:44:00'
               or generating_block.epoch_no is not null
@@ -65,27 +87,86 @@ FROM (with const as (select to_timestamp('{last_block}', 'YYYY-MM-DD HH24:MI:SS'
       SELECT sum(amount)
       FROM reward
       WHERE 
-        reward.addr_id IN ({stake_addr_ids})
-        AND reward.spendable_epoch <= {epoch}
+        reward.addr_id = ANY($2)
+        AND reward.spendable_epoch <= $3
       UNION
       SELECT sum(amount)
       FROM reserve
       WHERE 
-        reserve.addr_id IN ({stake_addr_ids}) 
-        AND reserve.tx_id <= {max_tx}
+        reserve.addr_id = ANY($2) 
+        AND reserve.tx_id <= $4
       UNION
       SELECT SUM(amount)
       FROM treasury
       WHERE 
-        treasury.addr_id IN ({stake_addr_ids})
-        AND treasury.tx_id <= {max_tx}
+        treasury.addr_id = ANY($2)
+        AND treasury.tx_id <= $4
       UNION
       SELECT -sum(amount)
       FROM withdrawal
       WHERE
-        withdrawal.addr_id IN ({stake_addr_ids})
-        AND withdrawal.tx_id <= {max_tx}
+        withdrawal.addr_id = ANY($2)
+        AND withdrawal.tx_id <= $4
      ) AS t;
+""")
+
+"""
+The POOL_STAKE_QUERY computes the live stake of every campaign pool in a single set-based pass.
+It replaces one STAKE_QUERY per pool plus one TOTAL_STAKE_QUERY per batch of 20 delegators.
+Parameters
+- %(pool_ids)s: Array of pool hash IDs.
+- %(max_tx)s: Last tx of the first block of the epoch.
+- %(effective_time)s: Time of the first block of the epoch.
+- %(epoch)s: Epoch to size pools at.
+Notes:
+- live_delegation keeps the latest delegation of each address up to max_tx (any pool), \
+    then drops addresses delegated elsewhere or deregistered after it, same as STAKE_QUERY.
+- Balance sources are the same as TOTAL_STAKE_QUERY, aggregated per address then per pool.
+"""
+POOL_STAKE_QUERY = LIVE_DELEGATION_CTE + """,
+balance AS (
+    SELECT t.stake_address_id AS addr_id, t.value AS amount
+    FROM tx_out AS t
+             INNER JOIN live_delegation l ON l.addr_id = t.stake_address_id
+             INNER JOIN tx AS generating_tx ON generating_tx.id = t.tx_id
+             INNER JOIN block AS generating_block ON generating_block.id = generating_tx.block_id
+             LEFT JOIN tx_in AS consuming_input ON consuming_input.tx_out_id = generating_tx.id
+        AND consuming_input.tx_out_index = t.index
+             LEFT JOIN tx AS consuming_tx ON consuming_tx.id = consuming_input.tx_in_id
+             LEFT JOIN block AS consuming_block ON consuming_block.id = consuming_tx.block_id
+    WHERE ( -- Ommit outputs from genesis after Allegra hard fork
+              %(effective_time)s < '2020-12-16 21:44:00'::timestamp
+              OR generating_block.epoch_no IS NOT NULL
+          )
+      AND %(effective_time)s >= generating_block.time -- Only outputs from blocks generated in the past
+      AND ( -- Only outputs consumed in the future or unconsumed outputs
+              %(effective_time)s <= consuming_block.time OR consuming_input.id IS NULL
+          )
+    UNION ALL
+    SELECT r.addr_id, r.amount
+    FROM reward r
+             INNER JOIN live_delegation l ON l.addr_id = r.addr_id
+    WHERE r.spendable_epoch <= %(epoch)s
+    UNION ALL
+    SELECT r.addr_id, r.amount
+    FROM reserve r
+             INNER JOIN live_delegation l ON l.addr_id = r.addr_id
+    WHERE r.tx_id <= %(max_tx)s
+    UNION ALL
+    SELECT t.addr_id, t.amount
+    FROM treasury t
+             INNER JOIN live_delegation l ON l.addr_id = t.addr_id
+    WHERE t.tx_id <= %(max_tx)s
+    UNION ALL
+    SELECT w.addr_id, -w.amount
+    FROM withdrawal w
+             INNER JOIN live_delegation l ON l.addr_id = w.addr_id
+    WHERE w.tx_id <= %(max_tx)s
+)
+SELECT l.pool_hash_id, COALESCE(SUM(b.amount), 0)
+FROM live_delegation l
+         LEFT JOIN balance b ON b.addr_id = l.addr_id
+GROUP BY l.pool_hash_id;
 """
 
 """
@@ -93,9 +174,9 @@ The GEN_SEED_QUERY is designed to retrieve specific delegation events and their
 The query focuses on the initial delegation transactions for specific pools \
 and ensures that only the latest delegation events up to a given epoch are considered.
 Parameters
-- {pool_ids}: A list of pool hash IDs.
-- {start_epoch}: Start of ISO.
-- {end_epoch}: End of ISO.
+- pool_ids: Array of pool hash IDs.
+- epoch_start: Start of ISO.
+- epoch_end: End of ISO.
 Notes:
 - Retrieve the latest delegation events up to a certain epoch for a specific set of pools.
 - Ensure that only the most recent delegation for each address is considered, \
@@ -107,22 +188,72 @@ SELECT d1.addr_id, d1.pool_hash_id, b.epoch_no, b.time, b.block_no
 FROM delegation d1
          INNER JOIN tx t ON d1.tx_id = t.id
          INNER JOIN block b ON b.id = t.block_id
-WHERE d1.pool_hash_id IN ({pool_ids})
+WHERE d1.pool_hash_id = ANY(%(pool_ids)s::bigint[])
   AND NOT EXISTS(
     SELECT TRUE FROM delegation d2 
-    WHERE d2.active_epoch_no < {end_epoch} AND d2.addr_id = d1.addr_id AND d2.tx_id > d1.tx_id
+    WHERE d2.active_epoch_no < %(epoch_end)s AND d2.addr_id = d1.addr_id AND d2.tx_id > d1.tx_id
   )
-  AND d1.active_epoch_no >= {start_epoch} AND d1.active_epoch_no < {end_epoch};
+  AND d1.active_epoch_no >= %(epoch_start)s AND d1.active_epoch_no < %(epoch_end)s;
 """
 
+"""
+MIN_GEN_SEED_QUERY is GEN_SEED_QUERY on the min_delegation index (DELEGATION_SOURCE=min_delegation),
+same parameters and rows: the latest delegation with active_epoch_no < epoch_end of every address
+delegating to one of the pools, kept when it is to one of the pools with active_epoch_no >= epoch_start.
+min_delegation holds the whole history of those addresses, block and time included, so no join is needed.
+"""
+MIN_GEN_SEED_QUERY = """
+SELECT addr_id, pool_hash_id, epoch_no, time, block_no
+FROM (
+    SELECT DISTINCT ON (addr_id) addr_id, pool_hash_id, active_epoch_no, epoch_no, time, block_no
+    FROM min_delegation
+    WHERE active_epoch_no < %(epoch_end)s
+      AND addr_id IN (
+        SELECT addr_id FROM min_delegation
+        WHERE pool_hash_id = ANY(%(pool_ids)s::bigint[])
+          AND active_epoch_no >= %(epoch_start)s AND active_epoch_no < %(epoch_end)s
+      )
+    ORDER BY addr_id, tx_id DESC
+) latest
+WHERE pool_hash_id = ANY(%(pool_ids)s::bigint[]) AND active_epoch_no >= %(epoch_start)s
+"""
+
+label_query('POOL_STAKE_QUERY', POOL_STAKE_QUERY)
+label_query('STAKE_QUERY', STAKE_QUERY.sql)
+label_query('GEN_SEED_QUERY', GEN_SEED_QUERY)
+label_query('MIN_GEN_SEED_QUERY', MIN_GEN_SEED_QUERY)
+
+# IsoManager shared with forked workers of build_rewards(parallel > 1)
+_manager = None
+
+
+def _fetch_pools_worker(epoch):
+    _manager.fetch_pools(epoch)
+    return epoch
+
+
+def _epoch_reward_worker(epoch):
+    output = _manager.compute_epoch_reward(epoch)
+    return epoch, encode_epoch_reward(output, settings.EPOCH_REWARD_ENCODING)
+
+
+def pools_checkpoint(pool_ids, epoch):
+    """Checkpoint of the batch engine over the pool stakes of epoch, IsoManager.save_pools clears it."""
+    return Checkpoint('get_pools_batch', pool_ids=sorted(pool_ids), epoch=epoch)
+
 
 class IsoManager:
     delegation = None
     reward_per_epoch = None
     map_address = None
     pool_ids = None
+    epoch_stakes = None
+    delegators = None
+    snapshot = None
+    results = None
 
-    def __init__(self, pools, epoch_start, epoch_end, total_reward, smallest_bonus, whale_limiter):
+    def __init__(self, pools, epoch_start, epoch_end, total_reward, smallest_bonus, whale_limiter, snapshot=None,
+                 namespace=None):
         self.pools = pools
         self.epoch_start = epoch_start
         self.epoch_end = epoch_end
@@ -130,203 +261,529 @@ class IsoManager:
         self.smallest_bonus = smallest_bonus
         self.whale_limiter = whale_limiter
         self.reward_per_epoch = Decimal(total_reward / (epoch_end - epoch_start))
+        self.epoch_stakes = {}
+        self.delegators = {}
+        # replay mode: read every dbsync input from a local snapshot
+        self.snapshot = snapshot
+        if snapshot:
+            # results are cached under the current engine's stake_source, it must be the one that sized the pools
+            snapshot.check_campaign(pools, epoch_start, epoch_end, settings.FETCH_POOLS_ENGINE)
+        self.params_hash = content_hash(pools=sorted(pools), epoch_start=epoch_start, epoch_end=epoch_end,
+                                        total_reward=total_reward, smallest_bonus=smallest_bonus,
+                                        whale_limiter=whale_limiter, **self.stake_source())[:16]
+        self.results = ResultCache(namespace or self.params_hash)
+        # metrics.StageRecorder of build_rewards, set by main --profile
+        self.recorder = None
+        # min_delegation refreshed for this run, see delegation_source
+        self.min_delegation_fresh = False
+
+    def seeds_key(self):
+        return self.results.key('gen_seeds', pool_ids=sorted(self.get_pool_ids()),
+                                epoch_start=self.epoch_start, epoch_end=self.epoch_end)
+
+    def totals_key(self, name):
+        """
+        Namespace key of the running totals state, per campaign parameters: a namespace reused with other
+        parameters starts from empty totals instead of adding to the previous ones.
+        """
+        return self.results.ns('%s:%s' % (name, self.params_hash))
+
+    @staticmethod
+    def stake_source():
+        # set and batch both rebuild live balances and share their results, keys stay unchanged for them
+        return {'stake_source': 'ledger'} if settings.FETCH_POOLS_ENGINE == 'epoch_stake' else {}
+
+    def pools_key(self, epoch):
+        return self.results.key('get_pools', pool_ids=sorted(self.get_pool_ids()), epoch=epoch,
+                                **self.stake_source())
+
+    def epoch_reward_key(self, epoch):
+        return self.results.key('epoch_reward', pool_ids=sorted(self.get_pool_ids()), epoch=epoch,
+                                smallest_bonus=self.smallest_bonus, whale_limiter=self.whale_limiter,
+                                reward_per_epoch=self.reward_per_epoch, **self.stake_source())
+
+    def clear_cache(self):
+        """Drop every stage result and the namespace state of this campaign, e.g. for a cold benchmark run."""
+        seeds = self.results.get(self.seeds_key())
+        epochs = {*range(self.epoch_start, self.epoch_end)}
+        if seeds:
+            epochs.update(s['epoch_no'] for s in json.loads(seeds))
+        final_key = self.results.ns('final_reward')
+        ledger = BalanceLedger(self.get_pool_ids(), self.results)
+        keys = [
+            self.seeds_key(),
+            DelegationIndex(self.get_pool_ids(), self.results).key,
+            *[self.pools_key(e) for e in epochs],
+            # balance boundaries of the incremental engine and checkpoints of the batch engine, at every sized epoch
+            *[ledger.key(e) for e in epochs],
+            *[pools_checkpoint(self.get_pool_ids(), e).key for e in epochs],
+            *[self.epoch_reward_key(e) for e in range(self.epoch_start, self.epoch_end)],
+            self.totals_key('final_reward_totals'),
+            self.totals_key('final_reward_epochs'),
+            self.totals_key('final_reward_until'),
+            final_key,
+            final_reward.manifest_key(final_key),
+            *['%s.%s' % (final_key, b) for b in range(settings.FINAL_REWARD_BUCKETS)],
+        ]
+        redis.delete(*keys)
+        self.delegation = None
+        self.map_address = None
+        self.epoch_stakes = {}
+        self.delegators = {}
+
+    def stage(self, name, epoch=None):
+        return self.recorder.stage(name, epoch) if self.recorder else nullcontext()
+
+    def build_rewards(self, parallel=1):
+        # the one-time delegation reads see the same database, each epoch task then pins its own
+        with pin_read_alias():
+            with self.stage('gen_seeds'):
+                seeds = self.gen_seeds()
+            with self.stage('get_delegation'):
+                self.get_delegation()
+        set_epoch_no = sorted({*[s.get('epoch_no') for s in seeds]})
+        if settings.EXTRACTION_ENGINE == 'async' and not self.snapshot:
+            with self.stage('extract_async'):
+                self.extract_async(set_epoch_no)
+        if parallel > 1:
+            self.build_rewards_parallel(set_epoch_no, parallel)
+            with self.stage('gen_final_reward'):
+                self.gen_final_reward()
+            return
 
-    def build_rewards(self):
-        seeds = self.gen_seeds()
-        set_epoch_no = {*[s.get('epoch_no') for s in seeds]}
         for epoch in set_epoch_no:
-            self.fetch_pools(epoch)
+            with self.stage('fetch_pools', epoch):
+                self.fetch_pools(epoch)
 
+        with self.stage('preload_epoch_stakes'):
+            self.preload_epoch_stakes()
         for epoch in range(self.epoch_start, self.epoch_end):
-            self.gen_epoch_reward(epoch)
+            with self.stage('gen_epoch_reward', epoch):
+                self.gen_epoch_reward(epoch)
+
+        with self.stage('gen_final_reward'):
+            self.gen_final_reward()
+
+    def extract_async(self, seed_epochs):
+        """
+        Run every fetch_pools, the epoch_stake preload and get_map_address at once on the asyncio
+        engine (smallest.aio). The stages that follow find their inputs cached or loaded.
+        """
+        # asyncpg is only needed by this engine
+        from smallest import aio
+
+        pending = [e for e in range(self.epoch_start, self.epoch_end)
+                   if not self.results.exists(self.epoch_reward_key(e))]
+        pool_epochs = [e for e in sorted({*seed_epochs, *pending}) if not self.results.exists(self.pools_key(e))]
+        if settings.FETCH_POOLS_ENGINE == 'incremental':
+            # each boundary chains on the previous one over psycopg2, fetch_pools sizes them in order afterwards
+            log.warning('extract_async|engine=incremental|pool_epochs=%s|left_to_fetch_pools', pool_epochs)
+            pool_epochs = []
+        stake_epoch_nos = [e + 2 for e in pending if e + 2 not in self.epoch_stakes]
+        # min_delegation has the addresses already, get_map_address reads them from it
+        with_addresses = bool(pending) and not self.map_address and settings.DELEGATION_SOURCE != 'min_delegation'
+        # Django ORM calls are not allowed in the event loop, load what they provide first
+        pool_ids = list(self.get_pool_ids())
+        addr_ids = self.get_delegation()['addr_id'].tolist()
+        log.info('extract_async|pool_epochs=%s|stake_epoch_nos=%s|addresses=%s', pool_epochs, stake_epoch_nos,
+                 len(addr_ids) if with_addresses else 0)
+
+        pools, stakes, map_address = asyncio.run(aio.extract(
+            pool_ids, pool_epochs, stake_epoch_nos, addr_ids, settings.FETCH_POOLS_ENGINE, with_addresses))
+        for epoch, map_total_stake in pools.items():
+            self.save_pools(epoch, map_total_stake)
+        self.epoch_stakes.update(stakes)
+        if map_address is not None:
+            self.map_address = map_address
+
+    def follow(self, poll_interval, on_publish=None):
+        """
+        Follow mode: poll dbsync and compute each campaign epoch as soon as it is final,
+        then publish the running totals. Returns once the last campaign epoch is published.
+        on_publish(epoch) runs after each publication, e.g. to export the stage metrics.
+        """
+        published = None
+        while True:
+            # one read database per poll, the epochs computed from it see the same dbsync state
+            with pin_read_alias():
+                final_epoch = self.last_final_epoch()
+                ready = [e for e in range(self.epoch_start, self.epoch_end)
+                         if final_epoch is not None and e <= final_epoch]
+                if ready and ready[-1] != published:
+                    pending = [e for e in ready if not self.results.exists(self.epoch_reward_key(e))]
+                    if pending:
+                        # delegations made since the last epoch, DelegationIndex.refresh only reads the new ones
+                        self.delegation = None
+                        self.map_address = None
+                        self.delegators = {}
+                        self.min_delegation_fresh = False
+                    for epoch in pending:
+                        with self.stage('fetch_pools', epoch):
+                            self.fetch_pools(epoch)
+                        with self.stage('gen_epoch_reward', epoch):
+                            self.gen_epoch_reward(epoch)
+                    with self.stage('gen_final_reward', ready[-1]):
+                        self.gen_final_reward(ready[-1] + 1)
+                    published = ready[-1]
+                    log.info('follow|published|epoch=%s|computed=%s', published, pending)
+                    if on_publish:
+                        on_publish(published)
+
+            if published == self.epoch_end - 1:
+                return
+            log.info('follow|wait|final_epoch=%s|poll_interval=%s', final_epoch, poll_interval)
+            # let dbsync use every connection while waiting
+            close_pools()
+            connections.close_all()
+            time.sleep(poll_interval)
+
+    def last_final_epoch(self):
+        """
+        Last epoch whose reward inputs are complete in dbsync: the next epoch started at least
+        FOLLOW_CONFIRMATIONS blocks ago and the epoch_stake read for the reward is fully inserted.
+        """
+        tip = Block.objects.exclude(block_no=None).order_by('-id').first()
+        if not tip:
+            return None
+        first_block = Block.objects.filter(epoch_no=tip.epoch_no).exclude(block_no=None).order_by('id').first()
+        epoch = tip.epoch_no - 1
+        # the reward of epoch reads the epoch_stake of epoch + 2, which dbsync inserts during epoch + 1
+        if tip.block_no - first_block.block_no < settings.FOLLOW_CONFIRMATIONS \
+                or not self.epoch_stake_complete(epoch + 2):
+            epoch -= 1
+        return epoch
+
+    @staticmethod
+    def epoch_stake_complete(epoch_no):
+        with read_cursor() as cursor:
+            cursor.execute("SELECT to_regclass('epoch_stake_progress')")
+            if cursor.fetchone()[0] is None:
+                # dbsync before 13.2 has no progress table, FOLLOW_CONFIRMATIONS alone covers the insertion
+                return True
+            cursor.execute('SELECT completed FROM epoch_stake_progress WHERE epoch_no = %s', [epoch_no])
+            row = cursor.fetchone()
+            return bool(row and row[0])
+
+    def build_rewards_parallel(self, seed_epochs, parallel):
+        global _manager
+        epochs = [e for e in range(self.epoch_start, self.epoch_end)
+                  if not self.results.exists(self.epoch_reward_key(e))]
+        log.info('build_rewards|parallel=%s|seed_epochs=%s|epochs=%s', parallel, seed_epochs, epochs)
+
+        # load shared data once, workers inherit it on fork
+        with self.stage('load_shared'):
+            self.get_pool_ids()
+            self.get_delegation()
+            if epochs:
+                self.get_map_address()
+        if settings.FETCH_POOLS_ENGINE == 'incremental':
+            # each balance boundary chains on the previous epoch's, workers sizing epochs on their own would
+            # recompute every one in full: size them in order here, the workers find them cached
+            for epoch in sorted({*seed_epochs, *epochs}):
+                with self.stage('fetch_pools', epoch):
+                    self.fetch_pools(epoch)
+            seed_epochs = []
+        _manager = self
+
+        # workers must open their own connections instead of sharing the parent's sockets
+        connections.close_all()
+        close_pools()
+        # queries of the workers are not observed from here, only wall time, Redis bytes and parent RSS are
+        with multiprocessing.get_context('fork').Pool(parallel) as pool:
+            with self.stage('fetch_pools_parallel'):
+                for epoch in pool.imap_unordered(_fetch_pools_worker, seed_epochs):
+                    log.info('build_rewards|fetch_pools|DONE|epoch=%s', epoch)
+
+            # imap keeps submission order, so epoch_reward is written in epoch order
+            with self.stage('gen_epoch_reward_parallel'):
+                for epoch, data in pool.imap(_epoch_reward_worker, epochs):
+                    self.results.set(self.epoch_reward_key(epoch), data)
+                    self.fold_epoch_reward(self.epoch_reward_key(epoch), decode_epoch_reward(data))
+                    log.info('build_rewards|gen_epoch_reward|DONE|epoch=%s', epoch)
+        _manager = None
+
+    @pinned_reads
+    def extract_snapshot(self, path):
+        snapshot = Snapshot(path)
+        snapshot.create({'pools': sorted(self.pools), 'epoch_start': self.epoch_start, 'epoch_end': self.epoch_end,
+                         'fetch_pools_engine': settings.FETCH_POOLS_ENGINE})
+        log.info('extract_snapshot|path=%s', path)
+
+        snapshot.write_pool_hash(PoolHash.objects.filter(view__in=self.pools).values_list('id', 'view'))
+        snapshot.write_delegation(self.get_delegation())
+        seeds = self.gen_seeds()
+        snapshot.write_seeds(seeds)
 
-        self.gen_final_reward()
+        # gen_epoch_reward sizes pools at every campaign epoch too, not only the seed epochs
+        epochs = sorted({*[s['epoch_no'] for s in seeds], *range(self.epoch_start, self.epoch_end)})
+        for epoch in epochs:
+            snapshot.write_pool_stakes(epoch, self.fetch_pools(epoch))
+
+        addr_ids = self.get_delegation()['addr_id'].tolist()
+        for epoch in range(self.epoch_start, self.epoch_end):
+            epoch_no = epoch + 2
+            snapshot.write_epoch_stakes(epoch_no, load_epoch_stakes(addr_ids, [epoch_no])[epoch_no])
+            log.info('extract_snapshot|epoch_stake|epoch_no=%s', epoch_no)
+
+        snapshot.write_stake_address(self.get_map_address())
+        snapshot.close()
+        log.info('extract_snapshot|DONE|path=%s', path)
 
     def get_pool_ids(self):
         if self.pool_ids:
             return self.pool_ids
+        if self.snapshot:
+            self.pool_ids = self.snapshot.pool_ids()
+            return self.pool_ids
         self.pool_ids = PoolHash.objects.filter(view__in=self.pools).pk_list()
         return self.pool_ids
 
     def get_delegation(self):
-        if self.delegation:
+        if self.delegation is not None:
+            return self.delegation
+        if self.snapshot:
+            self.delegation = self.snapshot.delegation()
             return self.delegation
 
-        pool_ids = self.get_pool_ids()
-        query = Delegation.objects.filter(pool_hash_id__in=pool_ids)
-
-        # on each epoch, get last delegation of stake address
-        m = {}
-        for d in query:
-            k = (d.addr_id, d.active_epoch_no)
-            if k not in m:
-                m[k] = (d.tx_id, d.pool_hash_id)
-            else:
-                tx_id, _ = m[k]
-                if tx_id < d.tx_id:
-                    m[k] = (d.tx_id, d.pool_hash_id)
-
-        # get transaction info like: epoch, time, tx_id
-        tx_ids = [d[0] for d in m.values()]
-        map_tx_block_id = {}
-        map_block_id_block = {}
-        for start, end in split_array_index(len(tx_ids)):
-            d = dict(Tx.objects.filter(id__in=tx_ids[start:end]).values_list('id', 'block_id'))
-            map_tx_block_id.update(d)
-            for b in Block.objects.filter(id__in=d.values()):
-                map_block_id_block[b.id] = b
-
-        result = []
-        for k, v in m.items():
-            addr_id, active_epoch_no = k
-            tx_id, pool_hash_id = v
-            b = map_block_id_block[map_tx_block_id[tx_id]]
-            result.append({
-                'addr_id': addr_id,
-                'active_epoch_no': active_epoch_no,
-                'tx_id': tx_id,
-                'pool_hash_id': pool_hash_id,
-                'epoch_no': b.epoch_no,
-                'time': b.time.strftime('%Y-%m-%dT%H:%M:%S'),
-            })
-        result = sorted(result, key=lambda kk: (kk['active_epoch_no'], kk['pool_hash_id']))
-        self.delegation = result
+        index = DelegationIndex(self.get_pool_ids(), self.results, self.delegation_source()).load().refresh()
+        self.delegation = index.records()
         return self.delegation
 
+    def delegation_source(self):
+        """settings.DELEGATION_SOURCE, min_delegation is refreshed for the campaign pools on its first use."""
+        if settings.DELEGATION_SOURCE == 'min_delegation' and not self.min_delegation_fresh:
+            min_delegation.refresh(self.get_pool_ids())
+            self.min_delegation_fresh = True
+        return settings.DELEGATION_SOURCE
+
+    def get_delegators(self, epoch):
+        if epoch not in self.delegators:
+            epochs = range(self.epoch_start, self.epoch_end)
+            if epoch not in epochs:
+                epochs = [epoch]
+            self.delegators.update(sweep_delegators(self.get_delegation(), epochs))
+        return self.get_delegation()[self.delegators[epoch]]
+
     def get_map_address(self):
         if self.map_address:
             return self.map_address
-        delegation = self.get_delegation()
-        addr_ids = [d['addr_id'] for d in delegation]
-        self.map_address = dict(StakeAddress.objects.filter(id__in=addr_ids).values_list('id', 'view'))
+        if self.snapshot:
+            self.map_address = self.snapshot.stake_address()
+            return self.map_address
+        if self.delegation_source() == 'min_delegation':
+            query = MinDelegation.objects.using('default').filter(pool_hash_id__in=self.get_pool_ids()) \
+                .values_list('addr_id', 'stake_address').distinct()
+            self.map_address = dict(stream_queryset(query))
+            return self.map_address
+        self.map_address = addresses.resolve(self.get_delegation()['addr_id'].tolist())
         return self.map_address
 
-    def get_point(self, lovelace, smallest):
-        if self.whale_limiter:
-            bound = Decimal(self.whale_limiter) * Decimal('1e6')  # Convert to Decimal
-            point = lovelace if lovelace <= bound else bound + (lovelace - bound) ** Decimal('0.9')
-        else:
-            point = lovelace
-
-        if smallest and self.smallest_bonus:
-            point = point * Decimal(self.smallest_bonus + 100) / Decimal(100)
-
-        return int(point)
-
-    def gen_final_reward(self):
-        log.info("generating_final_reward|START")
-
-        user_rewards = defaultdict(Decimal)
+    def preload_epoch_stakes(self):
+        # epoch_stake of epoch + 2 is used for the reward of epoch
+        epoch_nos = [e + 2 for e in range(self.epoch_start, self.epoch_end)
+                     if not self.results.exists(self.epoch_reward_key(e))]
+        epoch_nos = [e for e in epoch_nos if e not in self.epoch_stakes]
+        if not epoch_nos:
+            return
+        if self.snapshot:
+            self.epoch_stakes.update(self.snapshot.epoch_stakes(epoch_nos))
+            return
+        addr_ids = self.get_delegation()['addr_id'].tolist()
+        log.info('preload_epoch_stakes|epoch_nos=%s|addresses=%s', epoch_nos, len(addr_ids))
+        self.epoch_stakes.update(load_epoch_stakes(addr_ids, epoch_nos))
+
+    def get_epoch_stakes(self, epoch_no, addr_ids):
+        if epoch_no not in self.epoch_stakes:
+            if self.snapshot:
+                self.epoch_stakes.update(self.snapshot.epoch_stakes([epoch_no]))
+            else:
+                self.epoch_stakes[epoch_no] = load_epoch_stakes(addr_ids, [epoch_no])[epoch_no]
+        return self.epoch_stakes[epoch_no]
 
-        all_data = redis.hgetall('epoch_reward')
+    def get_point(self, lovelace, smallest):
+        return get_point(lovelace, smallest, self.whale_limiter, self.smallest_bonus)
+
+    def score_epoch(self, total_delegate, smallest):
+        """(points, percents, rewards) lists of the delegators of an epoch, from total_delegate and smallest arrays."""
+        if settings.SCORING_ENGINE == 'decimal':
+            points = [self.get_point(t, s) for t, s in zip(total_delegate.tolist(), smallest.tolist())]
+            total_point = sum(points)
+            log.info('gen_epoch_reward|total_point=%s', total_point)
+            shares = [get_share(point, total_point, self.reward_per_epoch) for point in points]
+            return points, [float(p) for p, _ in shares], [float(r) for _, r in shares]
+
+        points = score_points(total_delegate, smallest, self.whale_limiter, self.smallest_bonus)
+        log.info('gen_epoch_reward|total_point=%s', sum(points.tolist()))
+        percents, rewards = score_rewards(points, self.reward_per_epoch)
+        return points.tolist(), percents.tolist(), rewards.tolist()
+
+    def fold_epoch_reward(self, key, output):
+        """
+        Add one epoch_reward result to the campaign's running per-address totals.
+        final_reward_epochs records folded results so an epoch is never counted twice.
+        """
+        totals_key = self.totals_key('final_reward_totals')
+        epochs_key = self.totals_key('final_reward_epochs')
+
+        rewards = defaultdict(Decimal)
+        for record in output:
+            rewards[record['stake_address']] += Decimal(record['reward'])
+
+        stake_addresses = list(rewards.keys())
+        with redis.pipeline(transaction=True) as pipe:
+            while True:
+                # another process folding at the same time changes the watched keys and aborts the MULTI
+                pipe.watch(epochs_key, totals_key)
+                if pipe.sismember(epochs_key, key):
+                    log.info('fold_epoch_reward|SKIP|key=%s', key)
+                    return
+                totals = {}
+                for start, end in split_array_index(len(stake_addresses)):
+                    batch = stake_addresses[start:end]
+                    current = pipe.hmget(totals_key, batch)
+                    totals.update((a, str(rewards[a] + Decimal(c.decode() if c else 0)))
+                                  for a, c in zip(batch, current))
+                pipe.multi()
+                for start, end in split_array_index(len(stake_addresses)):
+                    pipe.hset(totals_key, mapping={a: totals[a] for a in stake_addresses[start:end]})
+                pipe.sadd(epochs_key, key)
+                try:
+                    pipe.execute()
+                    break
+                except WatchError:
+                    log.info('fold_epoch_reward|retry|key=%s', key)
+        log.info('fold_epoch_reward|key=%s|addresses=%s', key, len(stake_addresses))
+
+    def gen_final_reward(self, epoch_end=None):
+        """
+        Publish the campaign totals of epochs [epoch_start, epoch_end), all campaign epochs by default.
+        Partial totals (follow mode) only go to the campaign's keys, the batcher's final_reward key
+        is written once every campaign epoch is in.
+        """
+        epoch_end = epoch_end or self.epoch_end
+        complete = epoch_end == self.epoch_end
+        log.info("generating_final_reward|START|epoch_end=%s", epoch_end)
 
         # check if gen final_reward
-        if redis.get('final_reward'):
+        output_mode = settings.FINAL_REWARD_OUTPUT
+        final_key = self.results.ns('final_reward')
+        until_key = self.totals_key('final_reward_until')
+        # outputs written before follow mode existed always covered the whole campaign
+        published_until = int(redis.get(until_key) or self.epoch_end)
+        string_done = output_mode == 'sharded' or redis.exists(final_key)
+        sharded_done = output_mode == 'string' or redis.exists(final_reward.manifest_key(final_key))
+        if string_done and sharded_done and published_until == epoch_end:
             log.info("generating_final_reward|SKIP|ALL_DONE")
+            if output_mode != 'sharded' and complete:
+                redis.copy(final_key, 'final_reward', replace=True)
             return
 
-        for _, value in all_data.items():
-            epoch_data = json.loads(value)
-            for record in epoch_data:
-                user = record['stake_address']
-                total_reward = Decimal(record['reward'])
-                user_rewards[user] += total_reward
+        # fold epochs not counted yet, one epoch in memory at a time
+        folded = {f.decode() for f in redis.smembers(self.totals_key('final_reward_epochs'))}
+        for epoch in range(self.epoch_start, epoch_end):
+            key = self.epoch_reward_key(epoch)
+            if key in folded:
+                continue
+            data = self.results.get(key)
+            if data is None:
+                # evicted from the result cache, compute it again (gen_epoch_reward folds it)
+                self.gen_epoch_reward(epoch)
+                continue
+            self.fold_epoch_reward(key, decode_epoch_reward(data))
+
+        def _iter_totals():
+            for user, total_reward in redis.hscan_iter(self.totals_key('final_reward_totals'), count=2000):
+                yield user.decode(), int(Decimal(total_reward.decode()))
+
+        if output_mode in ('sharded', 'both'):
+            count, total = final_reward.write_sharded(_iter_totals(), prefix=final_key)
+            log.info('generating_final_reward|sharded|count=%s|total=%s', count, total)
 
-        json_data = json.dumps({k: int(v) for k, v in user_rewards.items()})
-        redis.set('final_reward', json_data)
+        if output_mode in ('string', 'both'):
+            json_data = json.dumps(dict(_iter_totals()))
+            redis.set(final_key, json_data)
+            if complete:
+                # final_reward is the key the batcher reads
+                redis.set('final_reward', json_data)
+        redis.set(until_key, epoch_end)
 
     def gen_epoch_reward(self, epoch):
-        cache_data = redis.hget('epoch_reward', "epoch.%s" % epoch)
-        if cache_data:
+        key = self.epoch_reward_key(epoch)
+        if self.results.exists(key):
             log.info("SKIP | gen_epoch_reward | epoch=%s", epoch)
             return
 
+        output = self.compute_epoch_reward(epoch)
+        data = encode_epoch_reward(output, settings.EPOCH_REWARD_ENCODING)
+        self.results.set(key, data)
+        self.fold_epoch_reward(key, output)
+
+    @pinned_reads
+    def compute_epoch_reward(self, epoch):
         log.info('gen_epoch_reward|epoch=%s', epoch)
         pool_records = self.fetch_pools(epoch)
         smallest_pool_id = None
         if pool_records and len(pool_records) > 0:
             smallest_pool_id = pool_records[0]['pool_id']
 
-        # get last delegation <= epoch
-        map_addr = {}
-        for d in self.get_delegation():
-            if d['epoch_no'] > epoch:
-                continue
-            if d['addr_id'] not in map_addr:
-                map_addr[d['addr_id']] = d
-            else:
-                if map_addr[d['addr_id']]['epoch_no'] < d['epoch_no']:
-                    map_addr[d['addr_id']] = d
-        result = []
-
-        def _worker(k):
-            try:
-                stake = EpochStake.objects.filter(addr_id=k, epoch_no=epoch + 2).first()
-                _total = stake.amount if stake else 0
-                smallest = stake and smallest_pool_id and smallest_pool_id == stake.pool_id
-                _v = map_addr[k]
-                _v['total_delegate'] = int(_total)
-                _v['smallest'] = smallest
-                _v['point'] = self.get_point(_total, _v['smallest'])
-                result.append(_v)
-                if settings.DEBUG:
-                    log.info('gen_epoch_reward|r|addr_id=%s|d=%s|point=%s|smallest=%s',
-                             k, int(_total), _v['point'], smallest)
-            except:
-                log.exception('gen_epoch_reward|worker|failed|epoch_no=%s|addr_id=%s|', epoch, k)
-
-        pool = ThreadPool(5)
-        pool.map(_worker, map_addr.keys())
-        pool.close()
-        pool.join()
-        total_point = sum([r['point'] for r in result])
-        log.info('gen_epoch_reward|total_point=%s', total_point)
-        for r in result:
-            percent = Decimal(r['point']) / total_point
-            reward = round_down(Decimal(self.reward_per_epoch) * percent)
-            percent = round_down(percent)
-            r['percent'] = str(percent)
-            r['reward'] = str(reward)
+        # last delegation <= epoch, one DELEGATION_DTYPE row per address
+        delegators = self.get_delegators(epoch)
+        addr_ids = delegators['addr_id'].tolist()
+        total_delegate, stake_pools, found = match_epoch_stakes(self.get_epoch_stakes(epoch + 2, addr_ids),
+                                                                delegators['addr_id'])
+        smallest = found & (stake_pools == smallest_pool_id) if smallest_pool_id is not None \
+            else np.zeros(len(addr_ids), dtype=bool)
+        self.epoch_stakes.pop(epoch + 2, None)
+        self.delegators.pop(epoch, None)
+
+        points, percents, rewards = self.score_epoch(total_delegate, smallest)
+        total_delegate = total_delegate.tolist()
+        smallest = smallest.tolist()
+        if settings.DEBUG:
+            for i, addr_id in enumerate(addr_ids):
+                log.info('gen_epoch_reward|r|addr_id=%s|d=%s|point=%s|smallest=%s',
+                         addr_id, total_delegate[i], points[i], smallest[i])
 
         output = []
         map_address = self.get_map_address()
-        for d in result:
-            r = OrderedDict()
-            r['epoch'] = epoch
-            r['stake_address'] = map_address[d['addr_id']]
-            r['stake_address_id'] = d['addr_id']
-            r['pool_hash_id'] = str(d['pool_hash_id'])
-            r['total_delegate'] = d['total_delegate']
-            r['point'] = d['point']
-            r['percent'] = round(float(d['percent']) * 100, 4)
-            r['reward'] = round(float(d['reward']), 4)
-            r['smallest'] = 1 if d['smallest'] else 0
-            output.append(r)
-
-        json_output = json.dumps(output)
-        redis.hset('epoch_reward', "epoch.%s" % epoch, json_output)
+        pool_hash_ids = delegators['pool_hash_id'].tolist()
+        for i, addr_id in enumerate(addr_ids):
+            output.append(EpochRecord(
+                epoch,
+                map_address[addr_id],
+                addr_id,
+                str(pool_hash_ids[i]),
+                total_delegate[i],
+                points[i],
+                round(percents[i] * 100, 4),
+                round(rewards[i], 4),
+                1 if smallest[i] else 0,
+            ))
+
+        return output
 
     def gen_seeds(self):
-        key = 'epoch.%s.%s' % (self.epoch_start, self.epoch_end)
-        result = redis.hget('gen_seeds', key)
+        if self.snapshot:
+            return self.snapshot.seeds()
+
+        key = self.seeds_key()
+        result = self.results.get(key)
         if result:
             return json.loads(result)
 
         DelegationInfo = namedtuple('DelegationInfo', ['addr_id', 'pool_id', 'epoch_no', 'time', 'block_no'])
-        pool_ids = ','.join([str(p) for p in self.get_pool_ids()])
-        with connection.cursor() as cursor:
-            raw_query = GEN_SEED_QUERY.format(
-                pool_ids=pool_ids,
-                start_epoch=self.epoch_start + 2,
-                end_epoch=self.epoch_end + 2,
-            )
-            if settings.DEBUG:
-                log.info('gen_seeds|raw_query=%s', raw_query)
-            cursor.execute(raw_query)
-            rows = [DelegationInfo(*r) for r in cursor.fetchall()]
-
+        params = {'pool_ids': list(self.get_pool_ids()), 'epoch_start': self.epoch_start + 2,
+                  'epoch_end': self.epoch_end + 2}
+        if settings.DEBUG:
+            log.info('gen_seeds|params=%s', params)
         seeds = []
-        for r in rows:
+        # not prepared: it runs once per campaign (the seeds are cached) and can return the whole delegation
+        # history of the pools, so it streams through a server-side cursor, and DECLARE cannot wrap an EXECUTE
+        if self.delegation_source() == 'min_delegation':
+            rows = stream(MIN_GEN_SEED_QUERY, params, alias='default')
+        else:
+            rows = stream(GEN_SEED_QUERY, params)
+        for r in map(DelegationInfo._make, rows):
             seeds.append({
                 'addr_id': r.addr_id,
                 'pool_id': r.pool_id,
@@ -336,64 +793,120 @@ class IsoManager:
             })
 
         result = json.dumps(seeds)
-        redis.hset('gen_seeds', key, result)
+        self.results.set(key, result)
         return seeds
 
+    @pinned_reads
     def fetch_pools(self, epoch):
-        key = 'key.%s' % epoch
-        result = redis.hget('get_pools', key)
+        if self.snapshot:
+            pools = self.snapshot.pool_stakes(epoch)
+            if not pools and self.get_pool_ids():
+                raise ValueError('snapshot %s has no pool stakes for epoch %s' % (self.snapshot.path, epoch))
+            return pools
+
+        key = self.pools_key(epoch)
+        result = self.results.get(key)
         if result:
             return json.loads(result)
 
-        log.info("fetch_pools|epoch=%s", epoch)
-        first_block = Block.objects.filter(epoch_no=epoch).order_by('id').first()
-        last_tx = Tx.objects.filter(block_id=first_block.id).order_by('-id').first()
+        log.info("fetch_pools|epoch=%s|engine=%s", epoch, settings.FETCH_POOLS_ENGINE)
+        return self.save_pools(epoch, self.pool_stakes(epoch))
 
+    def save_pools(self, epoch, map_total_stake):
         pools = []
         for pool_id in self.get_pool_ids():
-            log.info("fetching_pools|pool_id=%s", pool_id)
-            with connection.cursor() as cursor:
-                raw_query = STAKE_QUERY.format(pool_id=pool_id, max_tx=last_tx.id)
-                cursor.execute(raw_query)
-                stake_address_ids = [r[0] for r in cursor.fetchall()]
-
-            total_stakes = []
-
-            def _worker(batch_stake_address_ids):
-                with connection.cursor() as cursor:
-                    raw_query = TOTAL_STAKE_QUERY.format(
-                        stake_addr_ids=','.join([str(p) for p in batch_stake_address_ids]),
-                        max_tx=last_tx.id,
-                        last_block=first_block.time,
-                        epoch=epoch,
-                    )
-                    if settings.DEBUG:
-                        log.info('fetch_pools|raw_query=%s', raw_query)
-                    cursor.execute(raw_query)
-
-                    try:
-                        _total_stake = int(cursor.fetchone()[0])
-                        total_stakes.append(_total_stake)
-                    except TypeError:
-                        log.error('get_pools|pool_not_exists|raw_query=%s', raw_query)
-                        return
-
-            pool = ThreadPool(10)
-            batches = []
-            for start, end in split_array_index(len(stake_address_ids), 20):
-                batch = stake_address_ids[start:end]
-                batches.append(batch)
-
-            pool.map(_worker, batches)
-            pool.close()
-            pool.join()
-            total_stake = sum(total_stakes)
             pools.append({
                 'pool_id': pool_id,
-                'total_stake': total_stake,
+                'total_stake': map_total_stake.get(pool_id, 0),
             })
 
         pools = sorted(pools, key=lambda r: r['total_stake'])
         result = json.dumps(pools)
-        redis.hset('get_pools', key, result)
+        self.results.set(self.pools_key(epoch), result)
+        pools_checkpoint(self.get_pool_ids(), epoch).clear()
         return pools
+
+    @pinned_reads
+    def pool_stakes(self, epoch, engine=None):
+        """{pool_id: stake} of the campaign pools at the start of epoch, from the FETCH_POOLS_ENGINE stake source."""
+        engine = engine or settings.FETCH_POOLS_ENGINE
+        if engine == 'epoch_stake':
+            return self._fetch_pool_stakes_ledger(epoch)
+
+        if engine == 'incremental':
+            # reads its boundary block and txs itself, on the connection of its balances
+            return BalanceLedger(self.get_pool_ids(), self.results).pool_stakes(epoch)
+
+        first_block = Block.objects.filter(epoch_no=epoch).order_by('id').first()
+        last_tx = Tx.objects.filter(block_id=first_block.id).order_by('-id').first()
+        if engine == 'batch':
+            return self._fetch_pool_stakes_batch(epoch, first_block, last_tx)
+        return self._fetch_pool_stakes(epoch, first_block, last_tx)
+
+    def _fetch_pool_stakes_ledger(self, epoch):
+        # epoch_stake of epoch + 1 is the ledger snapshot taken at the boundary into epoch
+        query = EpochStake.objects.filter(epoch_no=epoch + 1, pool_id__in=self.get_pool_ids()) \
+            .values('pool_id').annotate(total=Sum('amount')).values_list('pool_id', 'total')
+        return {pool_id: int(total) for pool_id, total in query}
+
+    def _fetch_pool_stakes(self, epoch, first_block, last_tx):
+        params = {
+            'pool_ids': list(self.get_pool_ids()),
+            'max_tx': last_tx.id,
+            'effective_time': first_block.time,
+            'epoch': epoch,
+        }
+        if settings.DEBUG:
+            log.info('fetch_pools|pool_stake_query|params=%s', params)
+        return {pool_id: int(total) for pool_id, total in stream(POOL_STAKE_QUERY, params)}
+
+    def _fetch_pool_stakes_batch(self, epoch, first_block, last_tx):
+        map_total_stake = {}
+        # shared by every pool, starts at the legacy 20 delegators per query
+        batches = AdaptiveBatch(20)
+        # per pool: {offset, total} after each batch, done once the pool is summed
+        checkpoint = pools_checkpoint(self.get_pool_ids(), epoch)
+        progress = checkpoint.load()
+        if progress:
+            log.info('fetching_pools|resume|epoch=%s|pools=%s', epoch, len(progress))
+
+        def _worker(pool_id):
+            state = progress.get(str(pool_id), {'offset': 0, 'total': 0, 'done': False})
+            if state['done']:
+                log.info("fetching_pools|SKIP|pool_id=%s", pool_id)
+                map_total_stake[pool_id] = state['total']
+                return
+
+            log.info("fetching_pools|pool_id=%s|offset=%s", pool_id, state['offset'])
+            # one connection per pool, STAKE_QUERY and TOTAL_STAKE_QUERY are prepared once per connection
+            with read_cursor() as cursor:
+                STAKE_QUERY.execute(cursor, pool_id, last_tx.id)
+                # sorted, so offsets of a checkpoint stay valid on resume
+                stake_address_ids = sorted(r[0] for r in cursor.fetchall())
+
+                offset = state['offset']
+                total_stake = state['total']
+                for batch in batches.split(stake_address_ids[offset:]):
+                    start = time.perf_counter()
+                    TOTAL_STAKE_QUERY.execute(cursor, first_block.time, batch, epoch, last_tx.id)
+                    _total_stake = cursor.fetchone()[0]
+                    batches.observe(len(batch), time.perf_counter() - start)
+                    offset += len(batch)
+                    if _total_stake is None:
+                        log.error('get_pools|pool_not_exists|pool_id=%s|addr_ids=%s', pool_id, batch)
+                    else:
+                        total_stake += int(_total_stake)
+                    checkpoint.commit(pool_id, {'offset': offset, 'total': total_stake, 'done': False})
+            checkpoint.commit(pool_id, {'offset': offset, 'total': total_stake, 'done': True})
+            log.info('fetching_pools|DONE|pool_id=%s|batch_size=%s', pool_id, batches.size)
+            map_total_stake[pool_id] = total_stake
+
+        # the worker threads keep the read database pinned by the caller
+        context = contextvars.copy_context()
+        pool = ThreadPool(10)
+        pool.map(lambda pool_id: context.copy().run(_worker, pool_id), self.get_pool_ids())
+        pool.close()
+        pool.join()
+
+        # cleared by save_pools once the result is stored, a crash in between resumes with every pool done
+        return map_total_stake
@@ -0,0 +1,142 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test.utils import override_settings
+
+from smallest import addresses, min_delegation
+from smallest.db import close_pools
+from smallest.lib import IsoManager, redis
+from smallest.metrics import StageRecorder
+from smallest.models import Delegation, PoolHash
+from smallest.utils import split_array_index
+
+
+class Command(BaseCommand):
+    help = 'Benchmark every IsoManager stage on a synthetic dbsync (see gen_synthetic)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pool-list',
+            nargs='+',
+            type=str,
+            help='List of pools as strings, defaults to every synthetic pool',
+        )
+        parser.add_argument(
+            '--start-epoch',
+            type=int,
+            default=2,
+            help='Start epoch',
+        )
+        parser.add_argument(
+            '--end-epoch',
+            type=int,
+            default=8,
+            help='End epoch',
+        )
+        parser.add_argument(
+            '--total-reward',
+            type=int,
+            default=125000000000000,
+            help='Total reward',
+        )
+        parser.add_argument(
+            '--smallest-bonus',
+            type=int,
+            default=25,
+            help='Smallest bonus'
+        )
+        parser.add_argument(
+            '--whale-limiter',
+            type=int,
+            default=100000,
+            help='Whale limiter',
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=1,
+            help='Number of cold runs: the stage results, the stake address cache entries of the campaign and, '
+                 'with DELEGATION_SOURCE=min_delegation, the min_delegation index are dropped before each',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Write the per-stage report as JSON to this file',
+        )
+
+    def handle(self, *args, **kwargs):
+        pool_list = kwargs['pool_list'] or PoolHash.objects.filter(view__startswith='pool1synthetic') \
+            .flat_list('view')
+        runs = []
+        try:
+            for run in range(kwargs['repeat']):
+                iso_manager = IsoManager(
+                    pools=pool_list,
+                    epoch_start=kwargs['start_epoch'],
+                    epoch_end=kwargs['end_epoch'],
+                    total_reward=kwargs['total_reward'],
+                    smallest_bonus=kwargs['smallest_bonus'],
+                    whale_limiter=kwargs['whale_limiter'],
+                    namespace='bench',
+                )
+                iso_manager.clear_cache()
+                self.drop_shared_caches(pool_list)
+                recorder = StageRecorder()
+                # keep the published final_reward key untouched
+                with override_settings(FINAL_REWARD_OUTPUT='sharded'):
+                    self.run_stages(iso_manager, recorder)
+                runs.append(recorder.stages)
+                iso_manager.clear_cache()
+        finally:
+            close_pools()
+            connections.close_all()
+
+        for run, stages in enumerate(runs):
+            for s in stages:
+                self.stdout.write(
+                    'run={} stage={} epoch={} wall_time={:.3f}s queries={} query_time={:.3f}s rows={} '
+                    'peak_memory={:.1f}MB'.format(run, s['stage'], s['epoch'], s['wall_time'], s['queries'],
+                                                  s['query_time'], s['rows'], s['peak_memory'] / 2 ** 20)
+                )
+            self.stdout.write(self.style.SUCCESS('run={} total={:.3f}s'.format(
+                run, sum(s['wall_time'] for s in stages))))
+
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as f:
+                json.dump(runs, f, indent=2)
+        self.stdout.write(self.style.SUCCESS("ALL DONE!"))
+
+    @staticmethod
+    def drop_shared_caches(pool_list):
+        # caches shared by every campaign that clear_cache keeps, each run must rebuild them
+        pool_ids = PoolHash.objects.filter(view__in=pool_list).values_list('id', flat=True)
+        addr_ids = sorted(set(Delegation.objects.filter(pool_hash_id__in=list(pool_ids))
+                              .values_list('addr_id', flat=True)))
+        for start, end in split_array_index(len(addr_ids)):
+            redis.hdel(addresses.CACHE_KEY, *addr_ids[start:end])
+        if settings.DELEGATION_SOURCE == 'min_delegation':
+            # derived from dbsync only, the next refresh rebuilds it
+            min_delegation.create(rebuild=True)
+
+    @staticmethod
+    def run_stages(iso_manager, recorder):
+        with recorder.stage('get_pool_ids'):
+            iso_manager.get_pool_ids()
+        with recorder.stage('gen_seeds'):
+            seeds = iso_manager.gen_seeds()
+        with recorder.stage('get_delegation'):
+            iso_manager.get_delegation()
+        for epoch in sorted({s['epoch_no'] for s in seeds}):
+            with recorder.stage('fetch_pools', epoch):
+                iso_manager.fetch_pools(epoch)
+        with recorder.stage('preload_epoch_stakes'):
+            iso_manager.preload_epoch_stakes()
+        with recorder.stage('get_map_address'):
+            iso_manager.get_map_address()
+        for epoch in range(iso_manager.epoch_start, iso_manager.epoch_end):
+            with recorder.stage('gen_epoch_reward', epoch):
+                iso_manager.gen_epoch_reward(epoch)
+        with recorder.stage('gen_final_reward'):
+            iso_manager.gen_final_reward()
@@ -0,0 +1,77 @@
+import time
+
+import numpy as np
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from smallest.encoding import encode_epoch_reward, decode_epoch_reward
+from smallest.records import EpochRecord
+
+BECH32 = 'qpzry9x8gf2tvdw0s3jn54khce6mua7l'
+
+
+def fake_epoch_reward(size, seed):
+    rng = np.random.default_rng(seed)
+    total_delegate = (10 ** rng.uniform(6, 14, size)).astype(np.int64)
+    percent = total_delegate / total_delegate.sum()
+    output = []
+    for i in range(size):
+        output.append(EpochRecord(
+            450,
+            'stake1u' + ''.join(BECH32[c] for c in rng.integers(0, 32, 52)),
+            int(rng.integers(1, 10 ** 7)),
+            str(int(rng.integers(1, 3000))),
+            int(total_delegate[i]),
+            int(total_delegate[i]),
+            round(float(percent[i]) * 100, 4),
+            round(float(percent[i]) * 41666666666666.66, 4),
+            int(rng.random() < 0.1),
+        ))
+    return output
+
+
+class Command(BaseCommand):
+    help = 'Compare json and columnar epoch_reward encodings on a synthetic epoch'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=100000,
+            help='Delegators in the synthetic epoch',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed',
+        )
+        parser.add_argument(
+            '--redis',
+            action='store_true',
+            help='Also write both blobs to Redis and report MEMORY USAGE',
+        )
+
+    def handle(self, *args, **kwargs):
+        output = fake_epoch_reward(kwargs['size'], kwargs['seed'])
+        redis = cache.client.get_client(True) if kwargs['redis'] else None
+
+        for encoding in ['json', 'columnar']:
+            start = time.perf_counter()
+            data = encode_epoch_reward(output, encoding)
+            encode_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            decoded = decode_epoch_reward(data.encode() if isinstance(data, str) else data)
+            decode_elapsed = time.perf_counter() - start
+            # json decodes to dicts, columnar to EpochRecord
+            assert [dict(r) for r in decoded] == [dict(r) for r in output], 'round trip mismatch for %s' % encoding
+
+            line = 'encoding={} rows={} bytes={} encode={:.3f}s decode={:.3f}s'.format(
+                encoding, len(output), len(data), encode_elapsed, decode_elapsed)
+            if redis is not None:
+                key = 'bench_encoding.%s' % encoding
+                redis.hset(key, 'epoch.450', data)
+                line += ' redis_memory={}'.format(redis.memory_usage(key))
+                redis.delete(key)
+            self.stdout.write(self.style.SUCCESS(line))
@@ -0,0 +1,120 @@
+import time
+import tracemalloc
+from collections import OrderedDict
+from datetime import datetime, timezone
+from types import MappingProxyType
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from smallest.delegation import sweep_delegators
+from smallest.records import DELEGATION_DTYPE, TIME_FORMAT, EpochRecord
+
+
+def fake_delegations(size, epochs, seed):
+    """DELEGATION_DTYPE rows of `size` delegations, about two per address, spread over the epochs."""
+    rng = np.random.default_rng(seed)
+    rows = np.zeros(size, dtype=DELEGATION_DTYPE)
+    rows['addr_id'] = rng.integers(1, size // 2 + 2, size)
+    rows['epoch_no'] = rng.integers(0, epochs, size)
+    rows['active_epoch_no'] = rows['epoch_no'] + 2
+    rows['tx_id'] = np.arange(1, size + 1)
+    rows['pool_hash_id'] = rng.integers(1, 3000, size)
+    rows['time'] = 1596059091 + rows['epoch_no'].astype(np.int64) * 432000 + rng.integers(0, 432000, size)
+    return rows[np.lexsort((rows['pool_hash_id'], rows['active_epoch_no']))]
+
+
+def legacy_sweep(delegations, epochs):
+    # sweep_delegators before the compact records: a read-only dict per epoch over dict rows
+    stream = sorted(delegations, key=lambda d: d['epoch_no'])
+    result = {}
+    current = {}
+    i = 0
+    for epoch in sorted(epochs):
+        while i < len(stream) and stream[i]['epoch_no'] <= epoch:
+            d = stream[i]
+            last = current.get(d['addr_id'])
+            if last is None or last['epoch_no'] < d['epoch_no']:
+                current[d['addr_id']] = MappingProxyType(d)
+            i += 1
+        result[epoch] = MappingProxyType(dict(current))
+    return result
+
+
+def legacy_pipeline(rows, epochs):
+    keys = list(DELEGATION_DTYPE.names)
+    delegation = []
+    for r in rows.tolist():
+        d = dict(zip(keys, r))
+        d['time'] = datetime.fromtimestamp(d['time'], timezone.utc).strftime(TIME_FORMAT)
+        delegation.append(d)
+    delegators = legacy_sweep(delegation, epochs)
+    output = []
+    for addr_id, d in delegators[epochs[-1]].items():
+        r = OrderedDict()
+        r['epoch'] = epochs[-1]
+        r['stake_address'] = 'stake1u%052d' % addr_id
+        r['stake_address_id'] = addr_id
+        r['pool_hash_id'] = str(d['pool_hash_id'])
+        r['total_delegate'] = addr_id * 1000000
+        r['point'] = addr_id
+        r['percent'] = 0.0001
+        r['reward'] = 1.5
+        r['smallest'] = 0
+        output.append(r)
+    return delegation, delegators, output
+
+
+def compact_pipeline(rows, epochs):
+    delegation = rows.copy()
+    delegators = sweep_delegators(delegation, epochs)
+    last = delegation[delegators[epochs[-1]]]
+    output = [
+        EpochRecord(epochs[-1], 'stake1u%052d' % addr_id, addr_id, str(pool_hash_id), addr_id * 1000000, addr_id,
+                    0.0001, 1.5, 0)
+        for addr_id, pool_hash_id in zip(last['addr_id'].tolist(), last['pool_hash_id'].tolist())
+    ]
+    return delegation, delegators, output
+
+
+class Command(BaseCommand):
+    help = 'Compare the memory of dict and compact delegation / epoch_reward records on synthetic delegations'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=1000000,
+            help='Number of delegations',
+        )
+        parser.add_argument(
+            '--epochs',
+            type=int,
+            default=20,
+            help='Number of campaign epochs swept',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=1,
+            help='Random seed',
+        )
+
+    def handle(self, *args, **kwargs):
+        rows = fake_delegations(kwargs['size'], kwargs['epochs'], kwargs['seed'])
+        epochs = list(range(kwargs['epochs']))
+
+        for name, pipeline in [('dict', legacy_pipeline), ('compact', compact_pipeline)]:
+            tracemalloc.start()
+            start = time.perf_counter()
+            delegation, delegators, output = pipeline(rows, epochs)
+            elapsed = time.perf_counter() - start
+            retained, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.stdout.write(self.style.SUCCESS(
+                'records={} delegations={} delegators={} output={} retained={:.1f}MB peak={:.1f}MB time={:.2f}s'.format(
+                    name, len(delegation), len(delegators[epochs[-1]]), len(output),
+                    retained / 2 ** 20, peak / 2 ** 20, elapsed)
+            ))
+            del delegation, delegators, output
+        self.stdout.write(self.style.SUCCESS("ALL DONE!"))
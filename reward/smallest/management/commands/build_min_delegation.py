@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from smallest import min_delegation
+from smallest.models import PoolHash
+
+
+class Command(BaseCommand):
+    help = 'Build or incrementally refresh the min_delegation index (DELEGATION_SOURCE=min_delegation)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pool-list',
+            nargs='+',
+            type=str,
+            help='Pools to add to the index, the pools indexed already are always refreshed',
+        )
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            help='Drop the index first, e.g. after a dbsync resync',
+        )
+
+    def handle(self, *args, **kwargs):
+        pools = kwargs['pool_list'] or []
+        try:
+            views = dict(PoolHash.objects.using('default').filter(view__in=pools).values_list('view', 'id'))
+            missing = set(pools) - set(views)
+            if missing:
+                raise CommandError('Unknown pools: {}'.format(sorted(missing)))
+
+            min_delegation.create(rebuild=kwargs['rebuild'])
+            inserted, max_id = min_delegation.refresh(list(views.values()))
+            with connections['default'].cursor() as cursor:
+                cursor.execute('ANALYZE min_delegation')
+                cursor.execute('SELECT count(*) FROM min_delegation_pool')
+                indexed = cursor.fetchone()[0]
+        finally:
+            connections.close_all()
+
+        self.stdout.write(self.style.SUCCESS(
+            'Indexed pools: {} inserted: {} up to delegation id: {}'.format(indexed, inserted, max_id)))
+        self.stdout.write(self.style.SUCCESS("ALL DONE!"))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from smallest.bech32 import stake_address
+
+# CIP-19 reward address test vectors: header byte + stake credential hash, expected view
+CIP19_VECTORS = [
+    # stake key hash, mainnet
+    ('e1337b62cfff6403a06a3acbc34f8c46003c69fe79a3628cefa9c47251',
+     'stake1uyehkck0lajq8gr28t9uxnuvgcqrc6070x3k9r8048z8y5gh6ffgw'),
+    # stake key hash, testnet
+    ('e0337b62cfff6403a06a3acbc34f8c46003c69fe79a3628cefa9c47251',
+     'stake_test1uqehkck0lajq8gr28t9uxnuvgcqrc6070x3k9r8048z8y5gssrtvn'),
+    # script hash, mainnet
+    ('f1c37b1b5dc0669f1d3c61a6fddb2e8fde96be87b881c60bce8e8d542f',
+     'stake178phkx6acpnf78fuvxn0mkew3l0fd058hzquvz7w36x4gtcccycj5'),
+]
+
+
+class Command(BaseCommand):
+    help = 'Check the local bech32 encoding of stake addresses against the CIP-19 test vectors'
+
+    def handle(self, *args, **kwargs):
+        failed = 0
+        for hash_raw, expected in CIP19_VECTORS:
+            view = stake_address(bytes.fromhex(hash_raw))
+            if view == expected:
+                self.stdout.write(self.style.SUCCESS('{} OK'.format(expected)))
+            else:
+                failed += 1
+                self.stdout.write(self.style.ERROR('{} expected={} got={}'.format(hash_raw, expected, view)))
+
+        if failed:
+            raise CommandError('bech32 mismatch on {} of {} vectors'.format(failed, len(CIP19_VECTORS)))
+        self.stdout.write(self.style.SUCCESS("ALL DONE!"))
@@ -0,0 +1,112 @@
+import time
+from decimal import Decimal
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from smallest.scoring import get_point, get_share, score_points, score_rewards
+
+
+class Command(BaseCommand):
+    help = 'Check that the vectorized scoring path matches the Decimal path on random epochs'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size',
+            type=int,
+            default=500000,
+            help='Delegators per generated epoch',
+        )
+        parser.add_argument(
+            '--rounds',
+            type=int,
+            default=1,
+            help='Random epochs per parameter set',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed',
+        )
+        parser.add_argument(
+            '--total-reward',
+            type=int,
+            default=125000000000000,
+            help='Total reward',
+        )
+        parser.add_argument(
+            '--epochs',
+            type=int,
+            default=3,
+            help='Number of epochs the total reward is split into',
+        )
+
+    def handle(self, *args, **kwargs):
+        size = kwargs['size']
+        rng = np.random.default_rng(kwargs['seed'])
+        reward_per_epoch = Decimal(kwargs['total_reward'] / kwargs['epochs'])
+        params = [
+            (None, None),
+            (None, 25),
+            (100000, None),
+            (100000, 25),
+            (1000, 300),
+        ]
+
+        failed = 0
+        for whale_limiter, smallest_bonus in params:
+            # each round is one epoch of the same addresses, the campaign totals are summed over the rounds
+            totals = [Decimal(0)] * size
+            expected_totals = [Decimal(0)] * size
+            for _ in range(kwargs['rounds']):
+                # stakes from 1 ADA to ~300M ADA, log-uniform, plus a few empty ones
+                lovelace = (10 ** rng.uniform(6, 14.5, size)).astype(np.int64)
+                lovelace[rng.random(size) < 0.01] = 0
+                smallest = rng.random(size) < 0.3
+
+                start = time.perf_counter()
+                points = score_points(lovelace, smallest, whale_limiter, smallest_bonus)
+                percents, rewards = score_rewards(points, reward_per_epoch)
+                elapsed = time.perf_counter() - start
+
+                start = time.perf_counter()
+                expected_points = [get_point(int(v), bool(s), whale_limiter, smallest_bonus)
+                                   for v, s in zip(lovelace.tolist(), smallest.tolist())]
+                total_point = sum(expected_points)
+                shares = [get_share(p, total_point, reward_per_epoch) for p in expected_points]
+                decimal_elapsed = time.perf_counter() - start
+
+                point_mismatch = int(np.count_nonzero(points != np.array(expected_points, dtype=np.int64)))
+                # the values gen_epoch_reward stores, see IsoManager.compute_epoch_reward
+                percent_mismatch = sum(1 for v, (e, _) in zip(percents.tolist(), shares)
+                                       if round(v * 100, 4) != round(float(e) * 100, 4))
+                reward_mismatch = sum(1 for v, (_, e) in zip(rewards.tolist(), shares)
+                                      if round(v, 4) != round(float(e), 4))
+                max_error = max([abs(v - float(e)) for v, (_, e) in zip(rewards.tolist(), shares)] or [0])
+                failed += point_mismatch + percent_mismatch + reward_mismatch
+                # fold_epoch_reward sums Decimal(reward) of the stored rewards
+                totals = [t + Decimal(round(v, 4)) for t, v in zip(totals, rewards.tolist())]
+                expected_totals = [t + Decimal(round(float(e), 4)) for t, (_, e) in zip(expected_totals, shares)]
+
+                style = self.style.SUCCESS if not point_mismatch + percent_mismatch + reward_mismatch \
+                    else self.style.ERROR
+                self.stdout.write(style(
+                    'whale_limiter={} smallest_bonus={} size={} numpy={:.3f}s decimal={:.3f}s '
+                    'point_mismatch={} percent_mismatch={} reward_mismatch={} max_reward_error={:.6g}'.format(
+                        whale_limiter, smallest_bonus, size, elapsed, decimal_elapsed,
+                        point_mismatch, percent_mismatch, reward_mismatch, max_error,
+                    )
+                ))
+
+            # gen_final_reward keeps the integer part of each total
+            total_mismatch = sum(1 for t, e in zip(totals, expected_totals) if int(t) != int(e))
+            failed += total_mismatch
+            style = self.style.SUCCESS if not total_mismatch else self.style.ERROR
+            self.stdout.write(style('whale_limiter={} smallest_bonus={} rounds={} final_reward_mismatch={}'.format(
+                whale_limiter, smallest_bonus, kwargs['rounds'], total_mismatch,
+            )))
+
+        if failed:
+            raise CommandError('scoring mismatch on {} records'.format(failed))
+        self.stdout.write(self.style.SUCCESS("ALL DONE!"))
@@ -0,0 +1,140 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from smallest.db import close_pools, pin_read_alias
+from smallest.lib import IsoManager
+from smallest.models import PoolHash
+
+
+def rank(stakes, pool_ids):
+    # same order as IsoManager.fetch_pools, ties keep the pool_ids order
+    ordered = sorted(pool_ids, key=lambda p: stakes.get(p, 0))
+    return {pool_id: i for i, pool_id in enumerate(ordered)}
+
+
+class Command(BaseCommand):
+    help = 'Compare pool stakes and ranking of a live-UTXO stake source with epoch_stake (ledger snapshot) or set'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pool-list',
+            nargs='+',
+            type=str,
+            help='List of pools as strings',
+            required=True,
+        )
+        parser.add_argument(
+            '--start-epoch',
+            type=int,
+            help='Start epoch',
+            required=True,
+        )
+        parser.add_argument(
+            '--end-epoch',
+            type=int,
+            help='End epoch',
+            required=True,
+        )
+        parser.add_argument(
+            '--live-engine',
+            type=str,
+            default='set',
+            choices=['set', 'batch', 'incremental'],
+            help='Engine computing the live-UTXO stakes',
+        )
+        parser.add_argument(
+            '--reference-engine',
+            type=str,
+            default='epoch_stake',
+            choices=['epoch_stake', 'set'],
+            help='Engine the live stakes are compared with, set to check incremental against the full recompute',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Write the per-epoch, per-pool comparison as JSON to this file',
+        )
+
+    def handle(self, *args, **kwargs):
+        iso_manager = IsoManager(
+            pools=kwargs['pool_list'],
+            epoch_start=kwargs['start_epoch'],
+            epoch_end=kwargs['end_epoch'],
+            total_reward=0,
+            smallest_bonus=None,
+            whale_limiter=None,
+        )
+        epochs = []
+        try:
+            pool_ids = list(iso_manager.get_pool_ids())
+            views = dict(PoolHash.objects.filter(id__in=pool_ids).values_list('id', 'view'))
+            for epoch in range(iso_manager.epoch_start, iso_manager.epoch_end):
+                # both sources of an epoch read the same database
+                with pin_read_alias():
+                    start = time.perf_counter()
+                    live = iso_manager.pool_stakes(epoch, kwargs['live_engine'])
+                    live_time = time.perf_counter() - start
+                    start = time.perf_counter()
+                    reference = iso_manager.pool_stakes(epoch, kwargs['reference_engine'])
+                    reference_time = time.perf_counter() - start
+                epochs.append(self.compare(epoch, pool_ids, views, live, reference, live_time, reference_time))
+        finally:
+            close_pools()
+            connections.close_all()
+
+        for e in epochs:
+            style = self.style.SUCCESS if e['same_smallest'] else self.style.WARNING
+            self.stdout.write(style(
+                'epoch={epoch} smallest_live={smallest_live} smallest_reference={smallest_reference} '
+                'rank_changes={rank_changes} max_diff_pct={max_diff_pct:.4f} '
+                'live_time={live_time:.3f}s reference_time={reference_time:.3f}s'.format(**e)
+            ))
+            for p in e['pools']:
+                if p['rank_live'] != p['rank_reference']:
+                    self.stdout.write(
+                        '  pool={view} live={live} reference={reference} diff={diff} '
+                        'rank_live={rank_live} rank_reference={rank_reference}'.format(**p)
+                    )
+
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as f:
+                json.dump(epochs, f, indent=2)
+
+        differ = [e['epoch'] for e in epochs if not e['same_smallest']]
+        self.stdout.write(self.style.SUCCESS('Epochs: {} smallest pool differs in: {}'.format(len(epochs), differ)))
+        self.stdout.write(self.style.SUCCESS("ALL DONE!"))
+
+    @staticmethod
+    def compare(epoch, pool_ids, views, live, reference, live_time, reference_time):
+        rank_live = rank(live, pool_ids)
+        rank_reference = rank(reference, pool_ids)
+        pools = []
+        for pool_id in pool_ids:
+            live_stake = live.get(pool_id, 0)
+            reference_stake = reference.get(pool_id, 0)
+            pools.append({
+                'pool_id': pool_id,
+                'view': views.get(pool_id),
+                'live': live_stake,
+                'reference': reference_stake,
+                'diff': reference_stake - live_stake,
+                'diff_pct': (reference_stake - live_stake) / live_stake * 100 if live_stake else None,
+                'rank_live': rank_live[pool_id],
+                'rank_reference': rank_reference[pool_id],
+            })
+        smallest_live = min(rank_live, key=rank_live.get) if pool_ids else None
+        smallest_reference = min(rank_reference, key=rank_reference.get) if pool_ids else None
+        return {
+            'epoch': epoch,
+            'smallest_live': views.get(smallest_live, smallest_live),
+            'smallest_reference': views.get(smallest_reference, smallest_reference),
+            'same_smallest': smallest_live == smallest_reference,
+            'rank_changes': sum(1 for p in pools if p['rank_live'] != p['rank_reference']),
+            'max_diff_pct': max([abs(p['diff_pct']) for p in pools if p['diff_pct'] is not None], default=0.0),
+            'live_time': live_time,
+            'reference_time': reference_time,
+            'pools': pools,
+        }
@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from smallest import synthetic
+
+
+class Command(BaseCommand):
+    help = 'Fill a local Postgres with a synthetic dbsync subset for benchmarks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database',
+            type=str,
+            default='default',
+            help='Database alias to fill, its tables are dropped first',
+        )
+        parser.add_argument(
+            '--delegators',
+            type=int,
+            default=1000,
+            help='Number of stake addresses, 1k to 1M',
+        )
+        parser.add_argument(
+            '--pools',
+            type=int,
+            default=10,
+            help='Number of pools, 10 to 500',
+        )
+        parser.add_argument(
+            '--epochs',
+            type=int,
+            default=10,
+            help='Number of epochs, numbered from 0',
+        )
+        parser.add_argument(
+            '--blocks-per-epoch',
+            type=int,
+            default=20,
+            help='Blocks per epoch',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Allow a database whose name does not contain "synthetic"',
+        )
+
+    def handle(self, *args, **kwargs):
+        alias = kwargs['database']
+        name = connections[alias].settings_dict['NAME'] or ''
+        if 'synthetic' not in name and not kwargs['force']:
+            raise CommandError('refusing to drop dbsync tables in database "{}", '
+                               'use a database named *synthetic* or --force'.format(name))
+
+        with transaction.atomic(using=alias), connections[alias].cursor() as cursor:
+            pools = synthetic.generate(
+                cursor,
+                delegators=kwargs['delegators'],
+                pools=kwargs['pools'],
+                epochs=kwargs['epochs'],
+                blocks_per_epoch=kwargs['blocks_per_epoch'],
+                seed=kwargs['seed'],
+            )
+
+        self.stdout.write(self.style.SUCCESS('Database: {}'.format(name)))
+        self.stdout.write(self.style.SUCCESS('Pools: {} .. {}'.format(pools[0], pools[-1])))
+        self.stdout.write(self.style.SUCCESS("ALL DONE!"))
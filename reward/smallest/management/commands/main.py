@@ -1,6 +1,13 @@
-from django.core.management.base import BaseCommand
+import os
 
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from smallest.db import close_pools
 from smallest.lib import IsoManager
+from smallest.metrics import StageRecorder
+from smallest.snapshot import Snapshot
 
 
 class Command(BaseCommand):
@@ -40,6 +47,43 @@ class Command(BaseCommand):
             type=int,
             help='Whale limiter',
         )
+        parser.add_argument(
+            '--parallel',
+            type=int,
+            default=settings.REWARD_PARALLELISM,
+            help='Number of epochs computed at once in worker processes',
+        )
+        parser.add_argument(
+            '--snapshot',
+            type=str,
+            help='Replay the campaign from a snapshot file written by the snapshot command, without dbsync',
+        )
+        parser.add_argument(
+            '--namespace',
+            type=str,
+            help='Redis namespace of the campaign state, defaults to a hash of the campaign arguments',
+        )
+        parser.add_argument(
+            '--follow',
+            action='store_true',
+            help='Keep running and compute each epoch as soon as dbsync has it final',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=int,
+            default=settings.FOLLOW_POLL_INTERVAL,
+            help='With --follow, seconds between two polls of dbsync',
+        )
+        parser.add_argument(
+            '--profile',
+            type=str,
+            help='Record every stage and write profile.json and a Prometheus textfile reward.prom to this directory',
+        )
+        parser.add_argument(
+            '--cprofile',
+            action='store_true',
+            help='With --profile, run stages under cProfile and dump the slowest one to hottest_stage.prof',
+        )
 
     def handle(self, *args, **kwargs):
         pool_list = kwargs['pool_list']
@@ -48,6 +92,10 @@ class Command(BaseCommand):
         total_reward = kwargs['total_reward']
         smallest_bonus = kwargs['smallest_bonus']
         whale_limiter = kwargs['whale_limiter']
+        parallel = kwargs['parallel']
+        snapshot = Snapshot(kwargs['snapshot']) if kwargs['snapshot'] else None
+        if snapshot and kwargs['follow']:
+            raise CommandError('--follow polls dbsync, it cannot replay a snapshot')
 
         # Output the received arguments for demonstration purposes
         self.stdout.write(self.style.SUCCESS('Pool list: {}'.format(pool_list)))
@@ -56,6 +104,9 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS('Total reward: {}'.format(total_reward)))
         self.stdout.write(self.style.SUCCESS('Smallest bonus: {}'.format(smallest_bonus)))
         self.stdout.write(self.style.SUCCESS('Whale limiter: {}'.format(whale_limiter)))
+        self.stdout.write(self.style.SUCCESS('Parallel: {}'.format(parallel)))
+        if snapshot:
+            self.stdout.write(self.style.SUCCESS('Snapshot: {}'.format(snapshot.path)))
 
         iso_manager = IsoManager(
             pools=pool_list,
@@ -64,7 +115,47 @@ class Command(BaseCommand):
             total_reward=total_reward,
             smallest_bonus=smallest_bonus,
             whale_limiter=whale_limiter,
+            snapshot=snapshot,
+            namespace=kwargs['namespace'],
         )
-        iso_manager.build_rewards()
+        self.stdout.write(self.style.SUCCESS('Namespace: {}'.format(iso_manager.results.namespace)))
+        profile_dir = kwargs['profile']
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+            # tracemalloc slows every allocation down, peak RSS is sampled instead
+            iso_manager.recorder = StageRecorder(trace_memory=False, trace_redis=True, cprofile=kwargs['cprofile'])
+        try:
+            if kwargs['follow']:
+                # a follow run lasts for the whole campaign, export the metrics of every poll as it is published
+                on_publish = (lambda epoch: self.write_textfile(iso_manager, profile_dir)) if profile_dir else None
+                iso_manager.follow(kwargs['poll_interval'], on_publish)
+            else:
+                iso_manager.build_rewards(parallel=parallel)
+        finally:
+            close_pools()
+            connections.close_all()
+            if profile_dir:
+                self.write_profile(iso_manager, profile_dir, parallel)
 
         self.stdout.write(self.style.SUCCESS("ALL DONE!"))
+
+    def write_profile(self, iso_manager, profile_dir, parallel):
+        recorder = iso_manager.recorder
+        meta = {
+            'namespace': iso_manager.results.namespace,
+            'epoch_start': iso_manager.epoch_start,
+            'epoch_end': iso_manager.epoch_end,
+            'parallel': parallel,
+        }
+        recorder.write_report(os.path.join(profile_dir, 'profile.json'), **meta)
+        self.write_textfile(iso_manager, profile_dir)
+        self.stdout.write(self.style.SUCCESS('Profile: {}'.format(profile_dir)))
+        hottest = recorder.dump_hottest(os.path.join(profile_dir, 'hottest_stage.prof'))
+        if hottest:
+            self.stdout.write(self.style.SUCCESS('Hottest stage: {} epoch={} wall_time={:.3f}s'.format(
+                hottest['stage'], hottest['epoch'], hottest['wall_time'])))
+
+    @staticmethod
+    def write_textfile(iso_manager, profile_dir):
+        iso_manager.recorder.write_textfile(os.path.join(profile_dir, 'reward.prom'),
+                                            namespace=iso_manager.results.namespace)
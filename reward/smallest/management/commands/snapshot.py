@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from smallest.db import close_pools
+from smallest.lib import IsoManager
+
+
+class Command(BaseCommand):
+    help = 'Extract the dbsync rows a campaign needs into a local snapshot for main --snapshot'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pool-list',
+            nargs='+',
+            type=str,
+            help='List of pools as strings',
+            required=True,
+        )
+        parser.add_argument(
+            '--start-epoch',
+            type=int,
+            help='Start epoch',
+            required=True,
+        )
+        parser.add_argument(
+            '--end-epoch',
+            type=int,
+            help='End epoch',
+            required=True,
+        )
+        parser.add_argument(
+            '--path',
+            type=str,
+            help='Snapshot file to write',
+            required=True,
+        )
+
+    def handle(self, *args, **kwargs):
+        iso_manager = IsoManager(
+            pools=kwargs['pool_list'],
+            epoch_start=kwargs['start_epoch'],
+            epoch_end=kwargs['end_epoch'],
+            total_reward=0,
+            smallest_bonus=None,
+            whale_limiter=None,
+        )
+        try:
+            iso_manager.extract_snapshot(kwargs['path'])
+        finally:
+            close_pools()
+            connections.close_all()
+
+        self.stdout.write(self.style.SUCCESS('Snapshot: {}'.format(kwargs['path'])))
+        self.stdout.write(self.style.SUCCESS("ALL DONE!"))
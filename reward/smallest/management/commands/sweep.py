@@ -0,0 +1,116 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from smallest.db import close_pools
+from smallest.lib import IsoManager
+from smallest.snapshot import Snapshot
+from smallest.sweep import load_epoch_inputs, run_sweep
+
+
+class Command(BaseCommand):
+    help = 'Score a grid of smallest_bonus / whale_limiter / total_reward values on one load of the campaign'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pool-list',
+            nargs='+',
+            type=str,
+            help='List of pools as strings',
+            required=True,
+        )
+        parser.add_argument(
+            '--start-epoch',
+            type=int,
+            help='Start epoch',
+            required=True,
+        )
+        parser.add_argument(
+            '--end-epoch',
+            type=int,
+            help='End epoch',
+            required=True,
+        )
+        parser.add_argument(
+            '--total-reward',
+            nargs='+',
+            type=int,
+            help='Total rewards to try',
+            required=True,
+        )
+        parser.add_argument(
+            '--smallest-bonus',
+            nargs='+',
+            type=int,
+            default=[0],
+            help='Smallest bonuses to try, 0 for none',
+        )
+        parser.add_argument(
+            '--whale-limiter',
+            nargs='+',
+            type=int,
+            default=[0],
+            help='Whale limiters to try, 0 for none',
+        )
+        parser.add_argument(
+            '--top-n',
+            type=int,
+            default=100,
+            help='Size of the top group for top_n_share',
+        )
+        parser.add_argument(
+            '--snapshot',
+            type=str,
+            help='Read the campaign from a snapshot file instead of dbsync',
+        )
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='Write the results as JSON to this file',
+        )
+
+    def handle(self, *args, **kwargs):
+        snapshot = Snapshot(kwargs['snapshot']) if kwargs['snapshot'] else None
+        iso_manager = IsoManager(
+            pools=kwargs['pool_list'],
+            epoch_start=kwargs['start_epoch'],
+            epoch_end=kwargs['end_epoch'],
+            total_reward=0,
+            smallest_bonus=None,
+            whale_limiter=None,
+            snapshot=snapshot,
+        )
+        try:
+            start = time.perf_counter()
+            inputs = load_epoch_inputs(iso_manager)
+            load_elapsed = time.perf_counter() - start
+        finally:
+            close_pools()
+            connections.close_all()
+
+        start = time.perf_counter()
+        results = run_sweep(
+            inputs,
+            kwargs['smallest_bonus'],
+            kwargs['whale_limiter'],
+            kwargs['total_reward'],
+            kwargs['top_n'],
+        )
+        sweep_elapsed = time.perf_counter() - start
+
+        for r in results:
+            self.stdout.write(
+                'smallest_bonus={smallest_bonus} whale_limiter={whale_limiter} total_reward={total_reward} '
+                'recipients={recipients} gini={gini:.4f} top_{top_n}_share={top_n_share:.4f} '
+                'smallest_share={smallest_share:.4f} smallest_uplift={smallest_uplift} '
+                'max_reward={max_reward} median_reward={median_reward}'.format(**r)
+            )
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+
+        self.stdout.write(self.style.SUCCESS('Scenarios: {} load={:.1f}s sweep={:.1f}s'.format(
+            len(results), load_elapsed, sweep_elapsed)))
+        self.stdout.write(self.style.SUCCESS("ALL DONE!"))
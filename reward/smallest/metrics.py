@@ -0,0 +1,220 @@
+import cProfile
+import json
+import logging
+import os
+import re
+import resource
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+from smallest.db import observe_queries
+
+log = logging.getLogger('main')
+redis = cache.client.get_client(True)
+
+# seconds between two RSS samples while a stage runs
+RSS_SAMPLE_INTERVAL = 0.05
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# (normalized sql prefix, name) of the raw reward queries, see label_query
+_query_labels = []
+
+
+def _normalize(sql):
+    if isinstance(sql, bytes):
+        sql = sql.decode(errors='replace')
+    return ' '.join(sql[:2000].split())
+
+
+def label_query(name, sql):
+    """Report queries starting like sql, up to its first placeholder, as name."""
+    prefix = _normalize(re.split(r'\{|%\(', sql, maxsplit=1)[0])
+    _query_labels.append((prefix, name))
+
+
+def query_label(sql):
+    """Name of a raw reward query or prepared statement, orm:<table> for Django queries."""
+    text = _normalize(sql)
+    match = re.match(r'(?:PREPARE|EXECUTE) (\w+)', text)
+    if match:
+        return match.group(1)
+    for prefix, name in _query_labels:
+        if text.startswith(prefix):
+            return name
+    match = re.search(r'FROM "(\w+)"', text)
+    if match:
+        return 'orm:%s' % match.group(1)
+    return 'sql:%s' % text.split(' ', 1)[0].lower()
+
+
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except OSError:
+        # ru_maxrss is in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def redis_net_bytes():
+    """
+    (read, written) bytes of the Redis server since its start, as seen by clients.
+    Server-wide counters: forked workers are included, so are other clients of the same Redis.
+    """
+    stats = redis.info('stats')
+    return stats['total_net_output_bytes'], stats['total_net_input_bytes']
+
+
+class RssSampler(threading.Thread):
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = current_rss()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss())
+        return self.peak
+
+
+class StageRecorder:
+    """
+    Per-stage wall time, SQL query count and duration (also per query label), rows fetched,
+    Redis bytes read and written, peak RSS and, with trace_memory, peak Python memory.
+    With cprofile, every stage runs under cProfile and the profile of the slowest one is kept.
+    stage() blocks may not be nested.
+    """
+
+    def __init__(self, trace_memory=True, trace_redis=False, cprofile=False):
+        self.trace_memory = trace_memory
+        self.trace_redis = trace_redis
+        self.cprofile = cprofile
+        self.stages = []
+        self.hottest = None
+        self.hottest_profile = None
+
+    @contextmanager
+    def stage(self, name, epoch=None):
+        record = {
+            'stage': name,
+            'epoch': epoch,
+            'wall_time': 0.0,
+            'queries': 0,
+            'query_time': 0.0,
+            'rows': 0,
+            'redis_read': None,
+            'redis_written': None,
+            'peak_rss': None,
+            'peak_memory': None,
+            'sql': defaultdict(lambda: {'queries': 0, 'query_time': 0.0, 'rows': 0}),
+        }
+
+        def _observer(sql, duration, rowcount):
+            rows = max(rowcount or 0, 0)
+            record['queries'] += 1
+            record['query_time'] += duration
+            record['rows'] += rows
+            by_label = record['sql'][query_label(sql)]
+            by_label['queries'] += 1
+            by_label['query_time'] += duration
+            by_label['rows'] += rows
+
+        if self.trace_memory:
+            tracemalloc.start()
+            tracemalloc.reset_peak()
+        if self.trace_redis:
+            redis_start = redis_net_bytes()
+        sampler = RssSampler()
+        sampler.start()
+        profile = cProfile.Profile() if self.cprofile else None
+        start = time.perf_counter()
+        try:
+            with observe_queries(_observer):
+                if profile:
+                    profile.enable()
+                try:
+                    yield record
+                finally:
+                    if profile:
+                        profile.disable()
+        finally:
+            record['wall_time'] = time.perf_counter() - start
+            record['peak_rss'] = sampler.stop()
+            if self.trace_redis:
+                redis_end = redis_net_bytes()
+                record['redis_read'] = redis_end[0] - redis_start[0]
+                record['redis_written'] = redis_end[1] - redis_start[1]
+            if self.trace_memory:
+                record['peak_memory'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            record['sql'] = dict(record['sql'])
+            self.stages.append(record)
+            if profile and (self.hottest is None or record['wall_time'] > self.hottest['wall_time']):
+                self.hottest, self.hottest_profile = record, profile
+            log.info('stage|%s|epoch=%s|wall_time=%.3f|queries=%s|query_time=%.3f|rows=%s|redis_read=%s'
+                     '|redis_written=%s|peak_rss=%s|peak_memory=%s',
+                     name, epoch, record['wall_time'], record['queries'], record['query_time'], record['rows'],
+                     record['redis_read'], record['redis_written'], record['peak_rss'], record['peak_memory'])
+
+    def write_report(self, path, **meta):
+        _write_atomic(path, json.dumps({**meta, 'stages': self.stages}, indent=2, default=str))
+
+    def write_textfile(self, path, **labels):
+        """Prometheus textfile (node_exporter textfile collector), one sample per stage and epoch."""
+        metrics = [
+            ('wall_seconds', 'wall_time', 'Wall time of the stage'),
+            ('queries', 'queries', 'SQL queries run by the stage'),
+            ('query_seconds', 'query_time', 'Time spent in SQL queries'),
+            ('rows', 'rows', 'Rows fetched by SQL queries'),
+            ('redis_read_bytes', 'redis_read', 'Bytes read from Redis'),
+            ('redis_written_bytes', 'redis_written', 'Bytes written to Redis'),
+            ('peak_rss_bytes', 'peak_rss', 'Peak resident set size of the process'),
+        ]
+        lines = []
+        for metric, field, description in metrics:
+            lines.append('# HELP iso_stage_%s %s' % (metric, description))
+            lines.append('# TYPE iso_stage_%s gauge' % metric)
+            for record in self.stages:
+                if record[field] is None:
+                    continue
+                stage_labels = {**labels, 'stage': record['stage'], 'epoch': record['epoch']}
+                lines.append('iso_stage_%s{%s} %s' % (metric, _labels(stage_labels), record[field]))
+        for metric, field, description in metrics[1:4]:
+            lines.append('# HELP iso_query_%s %s, per query' % (metric, description))
+            lines.append('# TYPE iso_query_%s gauge' % metric)
+            for record in self.stages:
+                for query, values in record['sql'].items():
+                    query_labels = {**labels, 'stage': record['stage'], 'epoch': record['epoch'], 'query': query}
+                    lines.append('iso_query_%s{%s} %s' % (metric, _labels(query_labels), values[field]))
+        _write_atomic(path, '\n'.join(lines) + '\n')
+
+    def dump_hottest(self, path):
+        """Write the cProfile stats of the slowest stage, returns its record."""
+        if self.hottest_profile is None:
+            return None
+        self.hottest_profile.dump_stats(path)
+        return self.hottest
+
+
+def _labels(labels):
+    return ','.join('%s="%s"' % (k, '' if v is None else str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in labels.items())
+
+
+def _write_atomic(path, data):
+    # the textfile collector may read at any time, never expose a half written file
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.replace(tmp, path)
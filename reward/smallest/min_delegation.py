@@ -0,0 +1,106 @@
+import logging
+import time
+
+from django.db import connections, transaction
+
+from smallest.delegation import confirmed_tx_id
+
+log = logging.getLogger('main')
+
+"""
+min_delegation: incremental materialized index of the delegations read by the reward pipeline
+(DELEGATION_SOURCE=min_delegation), each joined once with its tx, block and stake address.
+- It holds every delegation, to any pool, of each address that ever delegated to an indexed pool,
+    so "latest delegation of the address" is answered from it alone.
+- min_delegation_pool lists the indexed pools with the delegation id they are indexed up to.
+    refresh() registers new pools with 0 and appends delegation rows above the marks, up to the last delegation
+    of a confirmed block (see smallest.delegation.confirmed_tx_id): rows are never revisited, so they must not be
+    rolled back by dbsync afterwards.
+- Written and read on the default database only, see smallest.db.LOCAL_TABLES.
+Drop both tables (--rebuild) after resyncing dbsync from scratch, ids may be assigned differently.
+"""
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS min_delegation (
+    id bigint PRIMARY KEY,
+    stake_address varchar(64) NOT NULL,
+    addr_id bigint NOT NULL,
+    pool_hash_id bigint NOT NULL,
+    active_epoch_no bigint NOT NULL,
+    tx_id bigint NOT NULL,
+    epoch_no bigint NOT NULL,
+    time timestamp NOT NULL,
+    block_no bigint
+);
+CREATE TABLE IF NOT EXISTS min_delegation_pool (
+    pool_hash_id bigint PRIMARY KEY,
+    delegation_id bigint NOT NULL
+);
+CREATE INDEX IF NOT EXISTS min_delegation_addr_tx ON min_delegation (addr_id, tx_id);
+CREATE INDEX IF NOT EXISTS min_delegation_pool_active ON min_delegation (pool_hash_id, active_epoch_no);
+CREATE INDEX IF NOT EXISTS min_delegation_pool_tx ON min_delegation (pool_hash_id, tx_id);
+"""
+DROP = 'DROP TABLE IF EXISTS min_delegation, min_delegation_pool'
+
+# serializes concurrent refreshes, the value is arbitrary
+LOCK_ID = 7210001
+
+INSERT = """
+INSERT INTO min_delegation (id, stake_address, addr_id, pool_hash_id, active_epoch_no, tx_id, epoch_no, time, block_no)
+SELECT d.id, sa.view, d.addr_id, d.pool_hash_id, d.active_epoch_no, d.tx_id, b.epoch_no, b.time, b.block_no
+FROM delegation d
+         INNER JOIN tx t ON t.id = d.tx_id
+         INNER JOIN block b ON b.id = t.block_id
+         INNER JOIN stake_address sa ON sa.id = d.addr_id
+WHERE d.id <= %(max_id)s AND {where}
+ON CONFLICT (id) DO NOTHING
+"""
+
+# whole history of the addresses delegating to an indexed pool for the first time
+NEW_ADDRESSES = INSERT.format(where="""d.addr_id IN (
+    SELECT n.addr_id
+    FROM delegation n
+             INNER JOIN min_delegation_pool p ON p.pool_hash_id = n.pool_hash_id
+    WHERE n.id > p.delegation_id AND n.id <= %(max_id)s
+      AND NOT EXISTS (SELECT TRUE FROM min_delegation m WHERE m.addr_id = n.addr_id)
+)""")
+
+# new delegations, to any pool, of the addresses indexed already
+NEW_DELEGATIONS = INSERT.format(where="""d.id > %(since)s
+  AND EXISTS (SELECT TRUE FROM min_delegation m WHERE m.addr_id = d.addr_id)""")
+
+
+def create(rebuild=False):
+    with connections['default'].cursor() as cursor:
+        if rebuild:
+            cursor.execute(DROP)
+        cursor.execute(SCHEMA)
+
+
+def refresh(pool_ids=()):
+    """
+    Register pool_ids and bring every indexed pool up to the last confirmed dbsync delegation.
+    Returns (rows inserted, delegation id indexed up to).
+    """
+    start = time.perf_counter()
+    create()
+    with transaction.atomic(using='default'), connections['default'].cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [LOCK_ID])
+        cursor.execute('INSERT INTO min_delegation_pool (pool_hash_id, delegation_id) '
+                       'SELECT unnest(%s::bigint[]), 0 ON CONFLICT DO NOTHING', [list(pool_ids)])
+        # delegation ids follow tx ids, every delegation up to max_id is in a confirmed block
+        cursor.execute('SELECT max(id) FROM delegation WHERE tx_id <= %s', [confirmed_tx_id(cursor)])
+        max_id = cursor.fetchone()[0] or 0
+        # every address indexed before this refresh has its history complete up to since
+        cursor.execute('SELECT coalesce(min(delegation_id), %s) FROM min_delegation_pool WHERE delegation_id > 0',
+                       [max_id])
+        since = cursor.fetchone()[0]
+
+        params = {'max_id': max_id, 'since': since}
+        cursor.execute(NEW_ADDRESSES, params)
+        inserted = cursor.rowcount
+        cursor.execute(NEW_DELEGATIONS, params)
+        inserted += cursor.rowcount
+        cursor.execute('UPDATE min_delegation_pool SET delegation_id = %s', [max_id])
+    log.info('min_delegation|refresh|pools=%s|since=%s|max_id=%s|inserted=%s|time=%.3f',
+             len(pool_ids), since, max_id, inserted, time.perf_counter() - start)
+    return inserted, max_id
@@ -1,3 +1,5 @@
+import itertools
+
 from django.db import models
 from django.db.models import QuerySet
 from django.db.models.manager import BaseManager
@@ -16,10 +18,13 @@ class MyQuerySet(QuerySet):
         return list(qs)
 
     def batch_iter(self, batch_size=2000):
-        total = self.count()
-        for start in range(0, total, batch_size):
-            end = min(start + batch_size, total)
-            yield self[start:end]
+        """Lists of batch_size results read through one server-side cursor, not an OFFSET scan per batch."""
+        rows = self.iterator(chunk_size=batch_size)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                return
+            yield batch
 
 
 class Manager(BaseManager.from_queryset(MyQuerySet)):
@@ -45,6 +50,7 @@ class PoolHash(models.Model):
 
 class StakeAddress(ModelBase):
     id = models.BigIntegerField(primary_key=True)
+    hash_raw = models.BinaryField()
     view = models.CharField(max_length=255)
 
     class Meta:
@@ -88,6 +94,7 @@ class Block(models.Model):
     id = models.BigIntegerField(primary_key=True)
     time = models.DateTimeField()
     epoch_no = models.BigIntegerField()
+    block_no = models.BigIntegerField(null=True)
 
     class Meta:
         db_table = 'block'
@@ -146,6 +153,7 @@ class MinDelegation(models.Model):
     tx_id = models.BigIntegerField()
     epoch_no = models.BigIntegerField()
     time = models.DateTimeField()
+    block_no = models.BigIntegerField(null=True)
 
     class Meta:
         db_table = 'min_delegation'
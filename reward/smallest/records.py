@@ -0,0 +1,74 @@
+from datetime import datetime, timezone
+
+import numpy as np
+
+"""
+Compact in-memory records of the reward pipeline:
+- delegations are one DELEGATION_DTYPE structured array (40 bytes a row) instead of a dict per row,
+    time in unix seconds. Per-epoch delegator sets are index arrays into it (see sweep_delegators).
+- the epoch_stake rows of an epoch are one EPOCH_STAKE_DTYPE array (24 bytes a row) sorted by addr_id.
+- epoch_reward rows are EpochRecord, a slotted record that reads like the dict it replaces.
+"""
+DELEGATION_DTYPE = np.dtype([
+    ('addr_id', '<i8'),
+    ('active_epoch_no', '<i4'),
+    ('tx_id', '<i8'),
+    ('pool_hash_id', '<i8'),
+    ('epoch_no', '<i4'),
+    ('time', '<i8'),
+])
+EPOCH_STAKE_DTYPE = np.dtype([
+    ('addr_id', '<i8'),
+    ('amount', '<i8'),
+    ('pool_id', '<i8'),
+])
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+EPOCH_REWARD_FIELDS = ('epoch', 'stake_address', 'stake_address_id', 'pool_hash_id', 'total_delegate', 'point',
+                       'percent', 'reward', 'smallest')
+
+
+def format_time(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime(TIME_FORMAT)
+
+
+def parse_time(text):
+    return int(datetime.strptime(text, TIME_FORMAT).replace(tzinfo=timezone.utc).timestamp())
+
+
+def delegation_array(rows):
+    """DELEGATION_DTYPE array of (addr_id, active_epoch_no, tx_id, pool_hash_id, epoch_no, time) tuples."""
+    return np.array([tuple(r) for r in rows], dtype=DELEGATION_DTYPE)
+
+
+def epoch_stake_array(chunks):
+    """EPOCH_STAKE_DTYPE array sorted by addr_id, from EPOCH_STAKE_DTYPE arrays or (addr_id, amount, pool_id) rows."""
+    chunks = [c if isinstance(c, np.ndarray) else np.array(c, dtype=EPOCH_STAKE_DTYPE) for c in chunks]
+    stakes = np.concatenate(chunks) if chunks else np.zeros(0, dtype=EPOCH_STAKE_DTYPE)
+    return stakes[np.argsort(stakes['addr_id'], kind='stable')]
+
+
+def match_epoch_stakes(stakes, addr_ids):
+    """(amount, pool_id, found) arrays aligned with addr_ids, amount and pool_id are 0 where not found."""
+    addr_ids = np.asarray(addr_ids, dtype=np.int64)
+    if not len(stakes):
+        zeros = np.zeros(len(addr_ids), dtype=np.int64)
+        return zeros, zeros.copy(), np.zeros(len(addr_ids), dtype=bool)
+    index = np.minimum(np.searchsorted(stakes['addr_id'], addr_ids), len(stakes) - 1)
+    found = stakes['addr_id'][index] == addr_ids
+    return np.where(found, stakes['amount'][index], 0), np.where(found, stakes['pool_id'][index], 0), found
+
+
+class EpochRecord:
+    """One epoch_reward row. r['reward'], dict(r) and json.dumps(..., default=dict) work as with a dict."""
+    __slots__ = EPOCH_REWARD_FIELDS
+
+    def __init__(self, *values):
+        for field, value in zip(EPOCH_REWARD_FIELDS, values):
+            setattr(self, field, value)
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def keys(self):
+        return EPOCH_REWARD_FIELDS
@@ -0,0 +1,72 @@
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+redis = cache.client.get_client(True)
+
+"""
+Redis layout of the reward pipeline:
+- iso:result:<stage>:<hash>: output of one stage, keyed by a content hash of every input it depends on.
+    Campaigns with the same inputs (e.g. the same pools sized at the same epoch) share it.
+    Each key expires RESULT_CACHE_TTL seconds after its last read or write, and Redis may evict
+    it earlier under memory pressure with maxmemory-policy volatile-lru.
+- iso:<namespace>:<name>: state owned by one campaign (running totals, final output). No TTL,
+    so it is never evicted from under a running campaign.
+- iso:stake_address: id -> bech32 view of every stake address seen, see smallest.addresses.
+- iso:checkpoint:<stage>:<hash>: finished units (pools, batches) of a stage still running, see Checkpoint.
+    Deleted once the stage completes, CHECKPOINT_TTL seconds after its last write if it never does.
+"""
+
+
+def content_hash(**inputs):
+    data = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, namespace, ttl=None):
+        self.namespace = namespace
+        self.ttl = settings.RESULT_CACHE_TTL if ttl is None else ttl
+
+    def key(self, stage, **inputs):
+        return 'iso:result:%s:%s' % (stage, content_hash(**inputs))
+
+    def ns(self, name):
+        return 'iso:%s:%s' % (self.namespace, name)
+
+    def get(self, key):
+        value = redis.get(key)
+        if value is not None and self.ttl:
+            # sliding expiry, results read recently stay around
+            redis.expire(key, self.ttl)
+        return value
+
+    def set(self, key, value):
+        redis.set(key, value, ex=self.ttl or None)
+
+    def exists(self, key):
+        return bool(redis.exists(key))
+
+
+class Checkpoint:
+    """
+    Hash of unit -> JSON value for the units a long stage has finished. Every commit is a single
+    HSET, so a unit is either fully recorded or not at all, and a restarted stage resumes from load().
+    """
+
+    def __init__(self, stage, **inputs):
+        self.key = 'iso:checkpoint:%s:%s' % (stage, content_hash(**inputs))
+
+    def load(self):
+        return {unit.decode(): json.loads(value) for unit, value in redis.hgetall(self.key).items()}
+
+    def commit(self, unit, value):
+        with redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self.key, unit, json.dumps(value))
+            pipe.expire(self.key, settings.CHECKPOINT_TTL)
+            pipe.execute()
+
+    def clear(self):
+        redis.delete(self.key)
@@ -0,0 +1,108 @@
+from decimal import Decimal
+
+import numpy as np
+
+from smallest.utils import round_down
+
+INT64_MAX = np.iinfo(np.int64).max
+# float 0.9 is slightly above Decimal('0.9'), y ** 0.9 is corrected by y ** -EXPONENT_ERROR
+EXPONENT_ERROR = float(Decimal(0.9) - Decimal('0.9'))
+
+
+def get_point(lovelace, smallest, whale_limiter=None, smallest_bonus=None):
+    if whale_limiter:
+        bound = Decimal(whale_limiter) * Decimal('1e6')  # Convert to Decimal
+        point = lovelace if lovelace <= bound else bound + (lovelace - bound) ** Decimal('0.9')
+    else:
+        point = lovelace
+
+    if smallest and smallest_bonus:
+        point = point * Decimal(smallest_bonus + 100) / Decimal(100)
+
+    return int(point)
+
+
+def get_share(point, total_point, reward_per_epoch):
+    percent = Decimal(point) / total_point
+    reward = round_down(Decimal(reward_per_epoch) * percent)
+    percent = round_down(percent)
+    return percent, reward
+
+
+def _near_integer(values):
+    # float64 carries a few ulps of error, anything that close to a truncation boundary is recomputed in Decimal
+    tol = np.spacing(np.abs(values)) * 4 + 1e-9
+    frac = values - np.floor(values)
+    return (frac < tol) | (frac > 1 - tol)
+
+
+def score_points(lovelace, smallest, whale_limiter=None, smallest_bonus=None):
+    """
+    Vectorized get_point for a whole epoch, equal to the Decimal path for every address.
+    Rows whose float result sits next to an integer boundary fall back to get_point.
+    """
+    lovelace = np.asarray(lovelace, dtype=np.int64)
+    smallest = np.asarray(smallest, dtype=bool)
+    points = lovelace.copy()
+
+    over = np.zeros(len(lovelace), dtype=bool)
+    values = np.zeros(len(lovelace), dtype=np.float64)
+    if whale_limiter:
+        bound = whale_limiter * 1000000
+        over = lovelace > bound
+        y = (lovelace[over] - bound).astype(np.float64)
+        z = y ** 0.9
+        values[over] = bound + (z - z * EXPONENT_ERROR * np.log(y))
+
+    bonus = smallest & bool(smallest_bonus)
+    if smallest_bonus:
+        factor = smallest_bonus + 100
+        exact = bonus & ~over
+        if len(lovelace) and int(lovelace.max()) <= INT64_MAX // factor:
+            points[exact] = lovelace[exact] * factor // 100
+        else:
+            points[exact] = [int(v) * factor // 100 for v in lovelace[exact]]
+        values[over & bonus] = values[over & bonus] * factor / 100
+
+    points[over] = np.floor(values[over]).astype(np.int64)
+    suspect = np.flatnonzero(over)[_near_integer(values[over])]
+    for i in suspect:
+        points[i] = get_point(int(lovelace[i]), bool(smallest[i]), whale_limiter, smallest_bonus)
+    return points
+
+
+def _truncation_suspect(scaled):
+    # scaled carries ~3 roundings of float error relative to its size, a floor that close to an integer
+    # (or beyond 2 ** 53, where every value is) may differ from the Decimal ROUND_DOWN
+    tol = np.spacing(np.abs(scaled)) * 8 + 1e-6
+    frac = scaled - np.floor(scaled)
+    return (frac < tol) | (frac > 1 - tol)
+
+
+def score_rewards(points, reward_per_epoch):
+    """
+    Vectorized get_share for a whole epoch, as floats rounded down to 6 decimals.
+    Every row whose 6-decimal truncation of the percent or the reward is not certain falls back to get_share,
+    as does every reward on a 4-decimal tie; the values gen_epoch_reward stores, round(percent * 100, 4)
+    and round(reward, 4), and the totals gen_final_reward sums from them then equal the Decimal path.
+    """
+    points = np.asarray(points, dtype=np.int64)
+    total_point = sum(points.tolist())
+    if not total_point:
+        zeros = np.zeros(len(points), dtype=np.float64)
+        return zeros, zeros.copy()
+
+    reward_per_epoch = Decimal(reward_per_epoch)
+    share = points / float(total_point)
+    scaled_percent = share * 1e6
+    scaled_reward = share * float(reward_per_epoch) * 1e6
+    percent = np.floor(scaled_percent) / 1e6
+    micro = np.floor(scaled_reward)
+    reward = micro / 1e6
+
+    suspect = _truncation_suspect(scaled_percent) | _truncation_suspect(scaled_reward) | (micro % 100 == 50)
+    for i in np.flatnonzero(suspect):
+        p, r = get_share(int(points[i]), total_point, reward_per_epoch)
+        percent[i] = float(p)
+        reward[i] = float(r)
+    return percent, reward
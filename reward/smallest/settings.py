@@ -54,6 +54,77 @@ DATABASES = {
     }
 }
 
+# Read-only dbsync replicas, comma separated host or host:port, e.g. DB_REPLICA_HOSTS=replica-1,replica-2:5433
+for i, replica in enumerate(h for h in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if h):
+    host, _, port = replica.partition(':')
+    DATABASES['replica_%s' % i] = {**DATABASES['default'], 'HOST': host, 'PORT': port or DATABASES['default']['PORT']}
+
+# reward queries are read-only, spread them across the replicas
+DATABASE_ROUTERS = ['smallest.db.ReadReplicaRouter']
+
+# Max open connections per database for raw reward queries (smallest.db.read_cursor)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+
+# Batched reward queries size their batches to finish in about this many seconds (smallest.db.AdaptiveBatch)
+DB_BATCH_TARGET_TIME = float(os.environ.get('DB_BATCH_TARGET_TIME', 2))
+
+# Rows fetched per round trip by the streamed reads of large extracts (smallest.db.stream)
+DB_STREAM_FETCH_SIZE = int(os.environ.get('DB_STREAM_FETCH_SIZE', 10000))
+
+# main --follow: seconds between two polls of the block table
+FOLLOW_POLL_INTERVAL = int(os.environ.get('FOLLOW_POLL_INTERVAL', 60))
+# ... and blocks the next epoch must have before an epoch is final (rollbacks, epoch_stake insertion)
+# also the depth below the tip up to which delegations are indexed (DelegationIndex, min_delegation)
+FOLLOW_CONFIRMATIONS = int(os.environ.get('FOLLOW_CONFIRMATIONS', 20))
+
+# Extraction engine of IsoManager.build_rewards:
+# - sync: stages query dbsync one after the other (Django ORM and smallest.db pooled cursors)
+# - async: fetch_pools, the epoch_stake loads and get_map_address of the whole campaign overlapped on asyncpg
+EXTRACTION_ENGINE = os.environ.get('EXTRACTION_ENGINE', 'sync')
+# Queries in flight at once per database with the async engine (smallest.aio)
+DB_ASYNC_CONCURRENCY = int(os.environ.get('DB_ASYNC_CONCURRENCY', 32))
+
+# Pool sizing engine used by IsoManager.fetch_pools:
+# - set: one POOL_STAKE_QUERY per epoch for every pool
+# - batch: legacy STAKE_QUERY per pool + TOTAL_STAKE_QUERY per adaptive batch of delegators
+# - epoch_stake: ledger snapshot, epoch_stake summed per pool in one grouped query. Much faster, but it is the
+#   stake at the epoch boundary rather than after its first block (see the compare_stake_sources command)
+# - incremental: same stakes as set, from the balances cached for the previous epoch plus the activity since
+#   (smallest.balances). Sizing consecutive epochs only reads the delta. The async engine leaves it to fetch_pools
+#   and REWARD_PARALLELISM > 1 sizes every epoch in order before forking
+FETCH_POOLS_ENGINE = os.environ.get('FETCH_POOLS_ENGINE', 'set')
+
+# Delegation source of get_delegation, gen_seeds and get_map_address:
+# - dbsync: delegation joined with tx, block and stake_address on every run
+# - min_delegation: the min_delegation index (smallest.min_delegation, see the build_min_delegation command),
+#   refreshed incrementally for the campaign pools at the start of a run. Needs write access to the default database
+DELEGATION_SOURCE = os.environ.get('DELEGATION_SOURCE', 'dbsync')
+
+# Scoring engine used by IsoManager.gen_epoch_reward:
+# - numpy: vectorized points and rewards for the whole epoch (see smallest.scoring)
+# - decimal: reference get_point / get_share per address
+# decimal stays the default until the check_scoring command reports zero differences on production-sized epochs
+SCORING_ENGINE = os.environ.get('SCORING_ENGINE', 'decimal')
+
+# Number of worker processes used by IsoManager.build_rewards, 1 runs epochs in order in-process
+REWARD_PARALLELISM = int(os.environ.get('REWARD_PARALLELISM', 1))
+
+# Encoding of epoch_reward hash fields: json, or columnar (versioned, compressed, see smallest.encoding)
+EPOCH_REWARD_ENCODING = os.environ.get('EPOCH_REWARD_ENCODING', 'json')
+
+# final_reward output: string (one JSON key, read by the batcher), sharded (smallest.final_reward buckets) or both
+FINAL_REWARD_OUTPUT = os.environ.get('FINAL_REWARD_OUTPUT', 'string')
+FINAL_REWARD_BUCKETS = int(os.environ.get('FINAL_REWARD_BUCKETS', 64))
+
+# Seconds a stage result (smallest.results) stays in Redis after its last use, 0 keeps it forever
+RESULT_CACHE_TTL = int(os.environ.get('RESULT_CACHE_TTL', 30 * 24 * 3600))
+
+# Seconds a checkpoint of an interrupted stage (smallest.results.Checkpoint) is kept for a resume.
+# Only the batch FETCH_POOLS_ENGINE is checkpointed, per pool and batch of delegators: the set, incremental and
+# epoch_stake engines, the epoch_stake preload and gen_epoch_reward restart the interrupted epoch from scratch,
+# epochs already done are kept in the result cache
+CHECKPOINT_TTL = int(os.environ.get('CHECKPOINT_TTL', 7 * 24 * 3600))
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
@@ -0,0 +1,150 @@
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from smallest.records import DELEGATION_DTYPE, epoch_stake_array, format_time, parse_time
+
+"""
+Local SQLite snapshot of everything one campaign reads from dbsync.
+IsoManager(snapshot=Snapshot(path)) replays a campaign from it without touching dbsync.
+- pool_stake holds fetch_pools output: the live-UTXO sizing needs the full tx_out/tx_in
+    history of every delegator, far more than the campaign itself, so the sized pools are kept instead.
+    They are sized by the FETCH_POOLS_ENGINE recorded in the campaign meta, a replay must run with the same one.
+- delegation holds get_delegation records (time as text), seed holds gen_seeds rows.
+"""
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS pool_hash (id INTEGER PRIMARY KEY, view TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS delegation (
+    addr_id INTEGER NOT NULL,
+    active_epoch_no INTEGER NOT NULL,
+    tx_id INTEGER NOT NULL,
+    pool_hash_id INTEGER NOT NULL,
+    epoch_no INTEGER NOT NULL,
+    time TEXT NOT NULL,
+    PRIMARY KEY (addr_id, active_epoch_no)
+);
+CREATE TABLE IF NOT EXISTS seed (
+    addr_id INTEGER NOT NULL,
+    pool_id INTEGER NOT NULL,
+    epoch_no INTEGER NOT NULL,
+    time TEXT NOT NULL,
+    block_no INTEGER
+);
+CREATE TABLE IF NOT EXISTS pool_stake (
+    epoch_no INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    pool_id INTEGER NOT NULL,
+    total_stake INTEGER NOT NULL,
+    PRIMARY KEY (epoch_no, position)
+);
+CREATE TABLE IF NOT EXISTS epoch_stake (
+    epoch_no INTEGER NOT NULL,
+    addr_id INTEGER NOT NULL,
+    amount INTEGER NOT NULL,
+    pool_id INTEGER NOT NULL,
+    PRIMARY KEY (epoch_no, addr_id)
+);
+CREATE TABLE IF NOT EXISTS stake_address (id INTEGER PRIMARY KEY, view TEXT NOT NULL);
+"""
+
+
+class Snapshot:
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._pid = None
+
+    @property
+    def conn(self):
+        # sqlite connections must not cross a fork
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path)
+            self._pid = os.getpid()
+        return self._conn
+
+    def create(self, campaign):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.conn.executescript(SCHEMA)
+        self.conn.execute('INSERT INTO meta VALUES (?, ?)', ('campaign', json.dumps(campaign)))
+        self.conn.commit()
+
+    def close(self):
+        if self._conn is not None and self._pid == os.getpid():
+            self._conn.close()
+        self._conn = None
+
+    def campaign(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'campaign'").fetchone()
+        return json.loads(row[0]) if row else None
+
+    def check_campaign(self, pools, epoch_start, epoch_end, fetch_pools_engine):
+        campaign = self.campaign()
+        expected = {'pools': sorted(pools), 'epoch_start': epoch_start, 'epoch_end': epoch_end,
+                    'fetch_pools_engine': fetch_pools_engine}
+        if campaign != expected:
+            raise ValueError('snapshot %s was extracted for %s, not %s' % (self.path, campaign, expected))
+
+    # writers, used by IsoManager.extract_snapshot
+
+    def write_pool_hash(self, rows):
+        self.conn.executemany('INSERT INTO pool_hash VALUES (?, ?)', rows)
+        self.conn.commit()
+
+    def write_delegation(self, records):
+        self.conn.executemany('INSERT INTO delegation VALUES (?, ?, ?, ?, ?, ?)', [
+            (addr_id, active_epoch_no, tx_id, pool_hash_id, epoch_no, format_time(t))
+            for addr_id, active_epoch_no, tx_id, pool_hash_id, epoch_no, t in records.tolist()
+        ])
+        self.conn.commit()
+
+    def write_seeds(self, seeds):
+        self.conn.executemany('INSERT INTO seed VALUES (?, ?, ?, ?, ?)', [
+            (s['addr_id'], s['pool_id'], s['epoch_no'], s['time'], s['block_no']) for s in seeds
+        ])
+        self.conn.commit()
+
+    def write_pool_stakes(self, epoch_no, pools):
+        self.conn.executemany('INSERT INTO pool_stake VALUES (?, ?, ?, ?)', [
+            (epoch_no, i, p['pool_id'], p['total_stake']) for i, p in enumerate(pools)
+        ])
+        self.conn.commit()
+
+    def write_epoch_stakes(self, epoch_no, stakes):
+        self.conn.executemany('INSERT INTO epoch_stake VALUES (?, ?, ?, ?)', [
+            (epoch_no, addr_id, amount, pool_id) for addr_id, amount, pool_id in stakes.tolist()
+        ])
+        self.conn.commit()
+
+    def write_stake_address(self, map_address):
+        self.conn.executemany('INSERT INTO stake_address VALUES (?, ?)', map_address.items())
+        self.conn.commit()
+
+    # readers, used by IsoManager in replay mode
+
+    def pool_ids(self):
+        return [r[0] for r in self.conn.execute('SELECT id FROM pool_hash ORDER BY id')]
+
+    def delegation(self):
+        query = 'SELECT addr_id, active_epoch_no, tx_id, pool_hash_id, epoch_no, time FROM delegation ' \
+                'ORDER BY active_epoch_no, pool_hash_id'
+        return np.array([(*r[:5], parse_time(r[5])) for r in self.conn.execute(query)], dtype=DELEGATION_DTYPE)
+
+    def seeds(self):
+        keys = ['addr_id', 'pool_id', 'epoch_no', 'time', 'block_no']
+        return [dict(zip(keys, r)) for r in self.conn.execute('SELECT * FROM seed ORDER BY rowid')]
+
+    def pool_stakes(self, epoch_no):
+        query = 'SELECT pool_id, total_stake FROM pool_stake WHERE epoch_no = ? ORDER BY position'
+        return [{'pool_id': r[0], 'total_stake': r[1]} for r in self.conn.execute(query, (epoch_no,))]
+
+    def epoch_stakes(self, epoch_nos):
+        query = 'SELECT addr_id, amount, pool_id FROM epoch_stake WHERE epoch_no = ?'
+        return {epoch_no: epoch_stake_array([self.conn.execute(query, (epoch_no,)).fetchall()])
+                for epoch_no in epoch_nos}
+
+    def stake_address(self):
+        return dict(self.conn.execute('SELECT id, view FROM stake_address'))
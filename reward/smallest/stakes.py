@@ -0,0 +1,37 @@
+import logging
+
+import numpy as np
+
+from smallest.models import EpochStake
+from smallest.records import EPOCH_STAKE_DTYPE, epoch_stake_array
+from smallest.utils import split_array_index
+
+log = logging.getLogger('main')
+
+
+def load_epoch_stakes(addr_ids, epoch_nos, batch_size=2000):
+    """
+    Bulk load epoch_stake rows for many addresses and epochs.
+    Returns {epoch_no: EPOCH_STAKE_DTYPE array sorted by addr_id}, one query per batch of addresses.
+    Not checkpointed: the rows of a batch cost as much to store in Redis as to read again.
+    """
+    addr_ids = sorted({*addr_ids})
+    epoch_nos = sorted({*epoch_nos})
+    chunks = {epoch_no: [] for epoch_no in epoch_nos}
+    if not addr_ids or not epoch_nos:
+        return {epoch_no: epoch_stake_array([]) for epoch_no in epoch_nos}
+
+    for start, end in split_array_index(len(addr_ids), batch_size):
+        query = EpochStake.objects.filter(
+            addr_id__in=addr_ids[start:end],
+            epoch_no__in=epoch_nos,
+        ).values_list('epoch_no', 'addr_id', 'amount', 'pool_id')
+        rows = {epoch_no: [] for epoch_no in epoch_nos}
+        # amount is a numeric lovelace column
+        for epoch_no, addr_id, amount, pool_id in query.iterator(chunk_size=batch_size):
+            rows[epoch_no].append((addr_id, int(amount), pool_id))
+        # tuples live for one batch only, the epochs are kept as arrays
+        for epoch_no, batch in rows.items():
+            if batch:
+                chunks[epoch_no].append(np.array(batch, dtype=EPOCH_STAKE_DTYPE))
+    return {epoch_no: epoch_stake_array(c) for epoch_no, c in chunks.items()}
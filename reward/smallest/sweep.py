@@ -0,0 +1,90 @@
+import itertools
+import logging
+
+import numpy as np
+
+from smallest.records import match_epoch_stakes
+from smallest.scoring import score_points
+
+log = logging.getLogger('main')
+
+
+def load_epoch_inputs(manager):
+    """
+    Stake data of every campaign epoch, loaded once: [(epoch, addr_ids, lovelace, smallest)] as arrays.
+    Reward parameters do not change any of it, so a whole grid can be scored from the same inputs.
+    """
+    inputs = []
+    for epoch in range(manager.epoch_start, manager.epoch_end):
+        pool_records = manager.fetch_pools(epoch)
+        smallest_pool_id = pool_records[0]['pool_id'] if pool_records else None
+        delegators = manager.get_delegators(epoch)
+        addr_ids = delegators['addr_id'].copy()
+        stakes = manager.get_epoch_stakes(epoch + 2, addr_ids.tolist())
+        lovelace, stake_pools, found = match_epoch_stakes(stakes, addr_ids)
+        smallest = found & (stake_pools == smallest_pool_id) if smallest_pool_id is not None \
+            else np.zeros(len(addr_ids), dtype=bool)
+        # only the aligned arrays are kept, not the epoch_stake rows nor the delegator set
+        manager.epoch_stakes.pop(epoch + 2, None)
+        manager.delegators.pop(epoch, None)
+        inputs.append((epoch, addr_ids, lovelace, smallest))
+        log.info('sweep|load_epoch|epoch=%s|delegators=%s', epoch, len(addr_ids))
+    return inputs
+
+
+def gini(values):
+    values = np.sort(values[values > 0])
+    if not len(values):
+        return 0.0
+    n = len(values)
+    index = np.arange(1, n + 1)
+    return float(2 * np.sum(index * values) / (n * np.sum(values)) - (n + 1) / n)
+
+
+def run_sweep(inputs, smallest_bonuses, whale_limiters, total_rewards, top_n=100):
+    """
+    Score every (smallest_bonus, whale_limiter, total_reward) combination.
+    Rewards are linear in total_reward, so each (smallest_bonus, whale_limiter) pair is scored once
+    and the distribution statistics are shared by all total rewards.
+    """
+    addr_index = np.unique(np.concatenate([i[1] for i in inputs])) if inputs else np.array([], dtype=np.int64)
+    epochs = len(inputs)
+    results = []
+    for smallest_bonus, whale_limiter in itertools.product(smallest_bonuses, whale_limiters):
+        # per-address share of the campaign, summed over epochs, for a total reward of 1
+        shares = np.zeros(len(addr_index), dtype=np.float64)
+        smallest_share = 0.0
+        smallest_stake_share = 0.0
+        for epoch, addr_ids, lovelace, smallest in inputs:
+            points = score_points(lovelace, smallest, whale_limiter or None, smallest_bonus or None)
+            total_point = points.sum(dtype=np.float64)
+            total_lovelace = lovelace.sum(dtype=np.float64)
+            if not total_point:
+                continue
+            epoch_shares = points / total_point / epochs
+            np.add.at(shares, np.searchsorted(addr_index, addr_ids), epoch_shares)
+            smallest_share += float(epoch_shares[smallest].sum())
+            if total_lovelace:
+                smallest_stake_share += float(lovelace[smallest].sum() / total_lovelace / epochs)
+
+        top = np.sort(shares)[::-1][:top_n]
+        stats = {
+            'recipients': int(np.count_nonzero(shares)),
+            'gini': gini(shares),
+            'top_n': top_n,
+            'top_n_share': float(top.sum()),
+            'smallest_share': smallest_share,
+            # reward share of smallest-pool delegators over their stake share, 1.0 means no uplift
+            'smallest_uplift': smallest_share / smallest_stake_share if smallest_stake_share else None,
+        }
+        for total_reward in total_rewards:
+            rewards = shares * total_reward
+            results.append({
+                'smallest_bonus': smallest_bonus,
+                'whale_limiter': whale_limiter,
+                'total_reward': total_reward,
+                'max_reward': int(rewards.max()) if len(rewards) else 0,
+                'median_reward': int(np.median(rewards[rewards > 0])) if np.count_nonzero(rewards) else 0,
+                **stats,
+            })
+    return results
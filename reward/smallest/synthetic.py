@@ -0,0 +1,213 @@
+import io
+import logging
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from smallest.bech32 import stake_address
+
+log = logging.getLogger('main')
+
+"""
+Synthetic dbsync subset for benchmarks: the tables in smallest.models plus stake_deregistration,
+tx_in and withdrawal, with only the columns the reward pipeline reads.
+Every delegator gets a few funding outputs (some spent later), one to three delegations,
+rewards, and occasionally a withdrawal, reserve/treasury payout or deregistration.
+Each event sits in its own tx, and every block gets one filler tx so fetch_pools always finds one.
+"""
+SCHEMA = """
+DROP TABLE IF EXISTS pool_hash, stake_address, block, tx, delegation, stake_deregistration,
+    tx_out, tx_in, reward, reserve, treasury, withdrawal, epoch_stake, min_delegation, min_delegation_pool;
+CREATE TABLE pool_hash (id bigint PRIMARY KEY, view varchar NOT NULL);
+CREATE TABLE stake_address (id bigint PRIMARY KEY, hash_raw bytea NOT NULL, view varchar NOT NULL);
+CREATE TABLE block (id bigint PRIMARY KEY, time timestamp NOT NULL, epoch_no bigint, block_no bigint);
+CREATE TABLE tx (id bigint PRIMARY KEY, block_id bigint NOT NULL);
+CREATE TABLE delegation (id bigint PRIMARY KEY, addr_id bigint NOT NULL, pool_hash_id bigint NOT NULL,
+    active_epoch_no bigint NOT NULL, tx_id bigint NOT NULL);
+CREATE TABLE stake_deregistration (id bigint PRIMARY KEY, addr_id bigint NOT NULL, tx_id bigint NOT NULL);
+CREATE TABLE tx_out (id bigint PRIMARY KEY, tx_id bigint NOT NULL, index smallint NOT NULL,
+    stake_address_id bigint, address varchar NOT NULL, value numeric NOT NULL);
+CREATE TABLE tx_in (id bigint PRIMARY KEY, tx_in_id bigint NOT NULL, tx_out_id bigint NOT NULL,
+    tx_out_index smallint NOT NULL);
+CREATE TABLE reward (id bigint PRIMARY KEY, addr_id bigint NOT NULL, type varchar NOT NULL, amount numeric NOT NULL,
+    pool_id bigint, earned_epoch bigint NOT NULL, spendable_epoch bigint NOT NULL);
+CREATE TABLE reserve (id bigint PRIMARY KEY, addr_id bigint NOT NULL, amount numeric NOT NULL, tx_id bigint NOT NULL);
+CREATE TABLE treasury (id bigint PRIMARY KEY, addr_id bigint NOT NULL, amount numeric NOT NULL, tx_id bigint NOT NULL);
+CREATE TABLE withdrawal (id bigint PRIMARY KEY, addr_id bigint NOT NULL, amount numeric NOT NULL,
+    tx_id bigint NOT NULL);
+CREATE TABLE epoch_stake (id bigint PRIMARY KEY, addr_id bigint NOT NULL, pool_id bigint NOT NULL,
+    amount numeric NOT NULL, epoch_no bigint NOT NULL);
+"""
+
+# the indexes dbsync ships for these lookups, created after loading
+INDEXES = """
+CREATE INDEX ON block (epoch_no);
+CREATE INDEX ON tx (block_id);
+CREATE INDEX ON delegation (addr_id);
+CREATE INDEX ON delegation (pool_hash_id);
+CREATE INDEX ON delegation (tx_id);
+CREATE INDEX ON stake_deregistration (addr_id);
+CREATE INDEX ON tx_out (stake_address_id);
+CREATE INDEX ON tx_out (tx_id);
+CREATE INDEX ON tx_in (tx_out_id, tx_out_index);
+CREATE INDEX ON reward (addr_id);
+CREATE INDEX ON reserve (addr_id);
+CREATE INDEX ON treasury (addr_id);
+CREATE INDEX ON withdrawal (addr_id);
+CREATE UNIQUE INDEX ON epoch_stake (epoch_no, addr_id, pool_id);
+CREATE INDEX ON epoch_stake (addr_id);
+ANALYZE;
+"""
+
+GENESIS = datetime(2021, 1, 1, tzinfo=timezone.utc)
+EPOCH_LENGTH = timedelta(days=5)
+
+
+def pool_view(i):
+    return 'pool1synthetic%06d' % i
+
+
+def stake_hash(i):
+    # mainnet stake key address header, then the id as credential hash
+    return b'\xe1' + i.to_bytes(28, 'big')
+
+
+def stake_view(i):
+    return stake_address(stake_hash(i))
+
+
+def _copy(cursor, table, columns, rows, batch_size=200000):
+    """COPY column arrays into table in batches."""
+    columns_sql = ', '.join(columns)
+    total = len(rows[0]) if rows else 0
+    for start in range(0, total, batch_size):
+        end = min(start + batch_size, total)
+        buf = io.StringIO()
+        for row in zip(*[c[start:end] for c in rows]):
+            buf.write('\t'.join(str(v) for v in row))
+            buf.write('\n')
+        buf.seek(0)
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table, columns_sql), buf)
+    log.info('synthetic|copy|table=%s|rows=%s', table, total)
+
+
+def generate(cursor, delegators=1000, pools=10, epochs=10, blocks_per_epoch=20, seed=0):
+    """Fill the dbsync subset through cursor. Epochs are numbered 0 .. epochs - 1."""
+    rng = np.random.default_rng(seed)
+    cursor.execute(SCHEMA)
+
+    addr_ids = np.arange(1, delegators + 1, dtype=np.int64)
+    pool_ids = np.arange(1, pools + 1, dtype=np.int64)
+    _copy(cursor, 'pool_hash', ['id', 'view'], [pool_ids.tolist(), [pool_view(i) for i in pool_ids.tolist()]])
+    _copy(cursor, 'stake_address', ['id', 'hash_raw', 'view'], [
+        addr_ids.tolist(),
+        # bytea hex input, the backslash escaped for COPY
+        ['\\\\x' + stake_hash(i).hex() for i in addr_ids.tolist()],
+        [stake_view(i) for i in addr_ids.tolist()],
+    ])
+
+    # blocks, evenly spread over each epoch
+    block_count = epochs * blocks_per_epoch
+    block_ids = np.arange(1, block_count + 1, dtype=np.int64)
+    block_epochs = (block_ids - 1) // blocks_per_epoch
+    block_times = [GENESIS + EPOCH_LENGTH * (e + (i % blocks_per_epoch) / blocks_per_epoch)
+                   for i, e in zip((block_ids - 1).tolist(), block_epochs.tolist())]
+    _copy(cursor, 'block', ['id', 'time', 'epoch_no', 'block_no'], [
+        block_ids.tolist(), [t.strftime('%Y-%m-%d %H:%M:%S') for t in block_times],
+        block_epochs.tolist(), block_ids.tolist(),
+    ])
+
+    # events, each one gets its own tx
+    outputs_per = rng.integers(1, 4, delegators)
+    out_addr = np.repeat(addr_ids, outputs_per)
+    out_epoch = rng.integers(0, epochs, len(out_addr))
+    out_value = (10 ** rng.normal(9.5, 1.2, len(out_addr))).astype(np.int64)
+    spent = (rng.random(len(out_addr)) < 0.4) & (out_epoch < epochs - 1)
+    # spent in a later epoch than the one it was created in
+    in_epoch = out_epoch[spent] + 1 + (rng.random(spent.sum()) * (epochs - 1 - out_epoch[spent])).astype(np.int64)
+
+    delegations_per = rng.integers(1, 4, delegators)
+    del_addr = np.repeat(addr_ids, delegations_per)
+    del_epoch = rng.integers(0, epochs, len(del_addr))
+    # a long tail: the first pools get most of the delegators
+    del_pool = np.minimum((rng.pareto(1.2, len(del_addr)) * pools / 8).astype(np.int64), pools - 1) + 1
+
+    dereg_addr = addr_ids[rng.random(delegators) < 0.02]
+    dereg_epoch = rng.integers(0, epochs, len(dereg_addr))
+    wd_addr = addr_ids[rng.random(delegators) < 0.1]
+    wd_epoch = rng.integers(0, epochs, len(wd_addr))
+    reserve_addr = addr_ids[rng.random(delegators) < 0.001]
+    reserve_epoch = rng.integers(0, epochs, len(reserve_addr))
+    treasury_addr = addr_ids[rng.random(delegators) < 0.001]
+    treasury_epoch = rng.integers(0, epochs, len(treasury_addr))
+
+    groups = [out_epoch, in_epoch, del_epoch, dereg_epoch, wd_epoch, reserve_epoch, treasury_epoch,
+              block_epochs]
+    event_epoch = np.concatenate(groups)
+    events = len(event_epoch) - block_count
+    event_block = np.concatenate([
+        event_epoch[:events] * blocks_per_epoch + rng.integers(0, blocks_per_epoch, events),
+        block_ids - 1,
+    ]) + 1
+    order = np.argsort(event_block, kind='stable')
+    event_tx = np.empty(len(event_block), dtype=np.int64)
+    event_tx[order] = np.arange(1, len(event_block) + 1)
+    _copy(cursor, 'tx', ['id', 'block_id'], [np.arange(1, len(event_block) + 1).tolist(), event_block[order].tolist()])
+
+    offsets = np.cumsum([0] + [len(g) for g in groups])
+    out_tx, in_tx, del_tx, dereg_tx, wd_tx, reserve_tx, treasury_tx = [
+        event_tx[offsets[i]:offsets[i + 1]] for i in range(7)]
+
+    _copy(cursor, 'tx_out', ['id', 'tx_id', 'index', 'stake_address_id', 'address', 'value'], [
+        np.arange(1, len(out_tx) + 1).tolist(), out_tx.tolist(), [0] * len(out_tx), out_addr.tolist(),
+        ['addr1synthetic%010d' % a for a in out_addr.tolist()], out_value.tolist(),
+    ])
+    _copy(cursor, 'tx_in', ['id', 'tx_in_id', 'tx_out_id', 'tx_out_index'], [
+        np.arange(1, len(in_tx) + 1).tolist(), in_tx.tolist(), out_tx[spent].tolist(), [0] * len(in_tx),
+    ])
+    _copy(cursor, 'delegation', ['id', 'addr_id', 'pool_hash_id', 'active_epoch_no', 'tx_id'], [
+        np.arange(1, len(del_tx) + 1).tolist(), del_addr.tolist(), del_pool.tolist(),
+        (del_epoch + 2).tolist(), del_tx.tolist(),
+    ])
+    _copy(cursor, 'stake_deregistration', ['id', 'addr_id', 'tx_id'], [
+        np.arange(1, len(dereg_tx) + 1).tolist(), dereg_addr.tolist(), dereg_tx.tolist(),
+    ])
+    _copy(cursor, 'withdrawal', ['id', 'addr_id', 'amount', 'tx_id'], [
+        np.arange(1, len(wd_tx) + 1).tolist(), wd_addr.tolist(),
+        rng.integers(1000000, 100000000, len(wd_tx)).tolist(), wd_tx.tolist(),
+    ])
+    for table, addrs, txs in [('reserve', reserve_addr, reserve_tx), ('treasury', treasury_addr, treasury_tx)]:
+        _copy(cursor, table, ['id', 'addr_id', 'amount', 'tx_id'], [
+            np.arange(1, len(txs) + 1).tolist(), addrs.tolist(),
+            rng.integers(1000000, 10000000000, len(txs)).tolist(), txs.tolist(),
+        ])
+
+    # rewards: a handful of earned epochs per delegator
+    rewards_per = rng.integers(0, min(epochs, 5) + 1, delegators)
+    reward_addr = np.repeat(addr_ids, rewards_per)
+    reward_epoch = rng.integers(0, epochs, len(reward_addr))
+    _copy(cursor, 'reward', ['id', 'addr_id', 'type', 'amount', 'pool_id', 'earned_epoch', 'spendable_epoch'], [
+        np.arange(1, len(reward_addr) + 1).tolist(), reward_addr.tolist(), ['member'] * len(reward_addr),
+        rng.integers(100000, 50000000, len(reward_addr)).tolist(),
+        rng.integers(1, pools + 1, len(reward_addr)).tolist(), reward_epoch.tolist(), (reward_epoch + 2).tolist(),
+    ])
+
+    # epoch_stake: at epoch e, the latest delegation made at or before e - 2, around a per-address balance
+    base_stake = (10 ** rng.normal(10, 1.2, delegators)).astype(np.int64)
+    order = np.lexsort((del_tx, del_addr))
+    del_addr, del_epoch, del_pool = del_addr[order], del_epoch[order], del_pool[order]
+    stake_id = 1
+    for epoch in range(2, epochs + 2):
+        active = del_epoch <= epoch - 2
+        a, p = del_addr[active], del_pool[active]
+        last = np.r_[a[1:] != a[:-1], True] if len(a) else np.array([], dtype=bool)
+        a, p = a[last], p[last]
+        amount = (base_stake[a - 1] * rng.uniform(0.95, 1.05, len(a))).astype(np.int64)
+        _copy(cursor, 'epoch_stake', ['id', 'addr_id', 'pool_id', 'amount', 'epoch_no'], [
+            np.arange(stake_id, stake_id + len(a)).tolist(), a.tolist(), p.tolist(), amount.tolist(),
+            [epoch] * len(a),
+        ])
+        stake_id += len(a)
+
+    cursor.execute(INDEXES)
+    return [pool_view(i) for i in pool_ids.tolist()]